@@ -32,5 +32,6 @@ fi
 # Launcher Config
 poetry run python viewerserver/module/3dserver/settings/launcher_config.py --config ./viewerserver/module/3dserver/config.json
 
-# Start Launcher Service
-poetry run python -m wslink.launcher ./viewerserver/module/3dserver/config.json
+# Start Launcher Service, with a pool of 3D servers started ahead of the sessions
+# Without the pool: poetry run python -m wslink.launcher ./viewerserver/module/3dserver/config.json
+poetry run python viewerserver/module/3dserver/launcher/warm_launcher.py ./viewerserver/module/3dserver/config.json
@@ -1,13 +1,46 @@
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
 
 from .settings import settings
 
+def _engine_options(url: str) -> dict:
+    if not url.startswith("sqlite"):
+        return {
+            "pool_size": settings.DB_POOL_SIZE,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "pool_timeout": settings.DB_POOL_TIMEOUT,
+            "pool_recycle": settings.DB_POOL_RECYCLE,
+            "pool_pre_ping": settings.DB_POOL_PRE_PING
+        }
+
+    if ":memory:" in url:
+        # Each connection would get its own empty in-memory database
+        return {"poolclass": StaticPool}
+
+    # SQLite allows a single writer, keep a small pool and let writers wait on the busy timeout
+    return {
+        "poolclass": AsyncAdaptedQueuePool,
+        "pool_size": settings.SQLITE_POOL_SIZE,
+        "max_overflow": 0,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "connect_args": {"timeout": settings.SQLITE_BUSY_TIMEOUT}
+    }
+
 engine = create_async_engine(
     settings.async_database_url,
     echo=settings.DB_ECHO_LOG,
-    poolclass=StaticPool
+    **_engine_options(settings.async_database_url)
 )
 
+if engine.dialect.name == "sqlite" and ":memory:" not in settings.async_database_url:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragma(dbapi_connection, connection_record) -> None:
+        # WAL lets readers run while a writer holds the database
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
\ No newline at end of file
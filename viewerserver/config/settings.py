@@ -28,6 +28,17 @@ class GlobalConfig(BaseSettings):
 
     DB_ECHO_LOG: bool = False
 
+    # Connection pool (PostgreSQL/asyncpg)
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+
+    # Connection pool (SQLite local mode)
+    SQLITE_POOL_SIZE: int = 5
+    SQLITE_BUSY_TIMEOUT: float = 15.0
+
     @property
     def async_database_url(self) -> Optional[str]:
         if self.ENVIRONMENT == EnvironmentEnum.LOCAL:
@@ -44,6 +55,24 @@ class GlobalConfig(BaseSettings):
     WADO_USER = "orthanc"
     WADO_PASSWORD = "orthanc"
 
+    # Upstream WADO-RS connection pool (one pool per store origin)
+    WADO_MAX_CONNECTIONS: int = 64
+    WADO_MAX_KEEPALIVE_CONNECTIONS: int = 32
+    WADO_KEEPALIVE_EXPIRY: float = 30.0
+    WADO_TIMEOUT: float = 60.0
+    # Requires the optional `h2` package (httpx[http2])
+    WADO_HTTP2: bool = False
+
+    # Frame cache: in-memory LRU tier, plus an on-disk tier when a path is set
+    WADO_FRAME_CACHE_MEMORY_BYTES: int = 256 * 1024 * 1024
+    WADO_FRAME_CACHE_MAX_ENTRY_BYTES: int = 32 * 1024 * 1024
+    WADO_FRAME_CACHE_DISK_PATH: Optional[str] = None
+    WADO_FRAME_CACHE_DISK_BYTES: int = 4 * 1024 * 1024 * 1024
+
+    # Resolved viewer sessions cached per process on the WADO hot path
+    SESSION_CACHE_TTL: float = 60.0
+    SESSION_CACHE_MAX_ENTRIES: int = 10000
+
     # Api V1 prefix
     API_V1_STR = "/v1"
 
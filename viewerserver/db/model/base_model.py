@@ -21,3 +21,9 @@ class BaseModel(Base):
     # @declared_attr
     # def __tablename__(cls) -> str:
     #     return cls.__name__.lower()
+
+
+def create_missing_indexes(connection) -> None:
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
@@ -1,7 +1,8 @@
 import abc
-from typing import Generic, TypeVar, Type
+from typing import Generic, List, TypeVar, Type
 from uuid import uuid4, UUID
 
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..errors import DoesNotExist
@@ -34,6 +35,23 @@ class BaseRepository(Generic[IN_SCHEMA, SCHEMA, TABLE], metaclass=abc.ABCMeta):
         await self._db_session.commit()
         return self._schema.from_orm(entry)
 
+    async def create_many(self, in_schemas: List[IN_SCHEMA]) -> List[SCHEMA]:
+        """
+        Insert all entries with a single multi-row INSERT, committed in one transaction.
+        """
+        rows = []
+        for in_schema in in_schemas:
+            row = in_schema.dict()
+            if 'id' not in row:
+                row['id'] = str(uuid4())
+            rows.append(row)
+        if not rows:
+            return []
+
+        await self._db_session.execute(insert(self._table).values(rows))
+        await self._db_session.commit()
+        return [self._schema.parse_obj(row) for row in rows]
+
     async def get_by_id(self, entry_id: UUID) -> SCHEMA:
         entry = await self._db_session.get(self._table, entry_id)
         if not entry:
@@ -8,10 +8,11 @@ from fastapi.staticfiles import StaticFiles
 from .module.coupons import router as coupon_router
 from .module.client import router as client_router
 from .module.wado import router as wado_router
+from .module.wado.client import wado_clients
 from .config.settings import settings
 
 from .config.session import engine
-from .db.model.base_model import Base
+from .db.model.base_model import Base, create_missing_indexes
 
 from .module.sessions.scheduler import remove_expired_sessions
 
@@ -57,6 +58,8 @@ async def schedule_periodic():
     # Auto-create Database Schema
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all skips existing tables, add indexes introduced after the table was created
+        await conn.run_sync(create_missing_indexes)
 
     # Run loop event periodically
     loop = asyncio.get_event_loop()
@@ -64,6 +67,11 @@ async def schedule_periodic():
     loop.create_task(remove_expired_sessions())
 
 
+@app.on_event("shutdown")
+async def close_wado_clients():
+    await wado_clients.aclose()
+
+
 @app.get("/")
 def main():
     return {"status": "ok"}
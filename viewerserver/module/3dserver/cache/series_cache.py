@@ -0,0 +1,190 @@
+import atexit
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+import logging
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Set
+
+from utils.utils import isAlive
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+'''
+Description: Total size in bytes of the files under a directory.
+'''
+def _size(path: str) -> int:
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+'''
+Description: Series cache shared by every 3D server process of a node.
+    Layout under root:
+        series/{key}/    published series, only extended by files derived from it (volume
+                         cache) under the lock of the series, see extend
+        tmp/{key}.{pid}  series being downloaded by process pid
+        locks/{key}.lock flock held while a process downloads the series
+        refs/{key}/{pid} one file per process using the series
+        cache.lock       flock serializing references and eviction
+    The key is a hash of the study and series UIDs. A series is downloaded into tmp/ and
+    renamed into series/ once complete, so a published series is always whole. A process
+    which needs a series another one is downloading blocks on its lock instead of polling.
+    Least recently used series are deleted when the cache grows over quota bytes, except
+    the ones referenced by a running process. Files left by dead processes are removed.
+'''
+class SeriesCache():
+    def __init__(self, root: str, quota: int) -> None:
+        self.root = root
+        self.quota = quota
+        for name in ("series", "tmp", "locks", "refs"):
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+        self.referenced: Set[str] = set()
+        self.tmpPaths: Set[str] = set()
+        atexit.register(self.close)
+
+    @staticmethod
+    def key(studyUID: str, seriesUID: str) -> str:
+        return hashlib.sha256(f"{studyUID}/{seriesUID}".encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, "series", key)
+
+    def lookup(self, key: str) -> Optional[str]:
+        '''
+        Description: Get a published series and mark it as recently used.
+        Return: the series directory, None if it is not in the cache
+        '''
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @contextmanager
+    def __flock(self, path: str) -> Iterator[None]:
+        with open(path, "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def lock(self, key: str):
+        '''
+        Description: Exclusive lock of a series, held while it is downloaded and published.
+            Blocks while another process holds it, and is released if that process dies.
+        '''
+        return self.__flock(os.path.join(self.root, "locks", f"{key}.lock"))
+
+    def reference(self, key: str) -> None:
+        # Taken before the lookup, so the series can not be evicted in between
+        with self.__flock(os.path.join(self.root, "cache.lock")):
+            refs = os.path.join(self.root, "refs", key)
+            os.makedirs(refs, exist_ok=True)
+            open(os.path.join(refs, str(os.getpid())), "w").close()
+        self.referenced.add(key)
+
+    def release(self, key: str) -> None:
+        try:
+            os.remove(os.path.join(self.root, "refs", key, str(os.getpid())))
+        except FileNotFoundError:
+            pass
+        self.referenced.discard(key)
+
+    def createTmpDir(self, key: str) -> str:
+        path = os.path.join(self.root, "tmp", f"{key}.{os.getpid()}")
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        self.tmpPaths.add(path)
+        return path
+
+    def publish(self, key: str, tmpPath: str) -> str:
+        '''
+        Description: Atomically move a downloaded series into the cache, then evict
+            least recently used series if the cache is over quota.
+            Must be called with the lock of the series held.
+        Return: the published series directory
+        '''
+        path = self.path(key)
+        os.rename(tmpPath, path)
+        self.tmpPaths.discard(tmpPath)
+        self.evict()
+        return path
+
+    def extend(self, key: str, write: Callable[[str], None]) -> bool:
+        '''
+        Description: Add files derived from a published series to its directory, with the lock
+            of the series held, then evict since the series grew.
+        Params:
+            write: called with the series directory
+        Return: False if the series is not in the cache anymore
+        '''
+        with self.lock(key):
+            path = self.lookup(key)
+            if path is None:
+                return False
+            write(path)
+        self.evict()
+        return True
+
+    def __isReferenced(self, key: str) -> bool:
+        refs = os.path.join(self.root, "refs", key)
+        try:
+            pids = os.listdir(refs)
+        except FileNotFoundError:
+            return False
+        referenced = False
+        for pid in pids:
+            if isAlive(int(pid)):
+                referenced = True
+            else:
+                # Left by a process which did not exit cleanly
+                os.remove(os.path.join(refs, pid))
+        return referenced
+
+    def evict(self) -> None:
+        removed = []
+        with self.__flock(os.path.join(self.root, "cache.lock")):
+            tmp = os.path.join(self.root, "tmp")
+            for name in os.listdir(tmp):
+                # {key}.{pid} or {key}.{pid}.{time} for an evicted series not deleted yet
+                parts = name.split(".")
+                if len(parts) > 1 and parts[1].isdigit() and not isAlive(int(parts[1])):
+                    removed.append(os.path.join(tmp, name))
+
+            entries = []
+            for key in os.listdir(os.path.join(self.root, "series")):
+                path = self.path(key)
+                entries.append((os.stat(path).st_mtime, key, _size(path)))
+            total = sum(size for _, _, size in entries)
+
+            for _, key, size in sorted(entries):
+                if total <= self.quota:
+                    break
+                if self.__isReferenced(key):
+                    continue
+                # Unpublish first, the files are deleted outside the lock
+                trashPath = os.path.join(tmp, f"{key}.{os.getpid()}.{time.time_ns()}")
+                os.rename(self.path(key), trashPath)
+                removed.append(trashPath)
+                total -= size
+                logging.info(f"Evicted series {key} ({size} bytes)")
+
+        for path in removed:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def close(self) -> None:
+        for key in list(self.referenced):
+            self.release(key)
+        for path in list(self.tmpPaths):
+            shutil.rmtree(path, ignore_errors=True)
+        self.tmpPaths.clear()
@@ -0,0 +1,103 @@
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+
+import numpy as np
+
+import json
+import os
+import threading
+import logging
+from typing import List, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Voxels in (z, y, x) order, rescale slope and intercept already applied
+VOLUME_FILE = "volume.npy"
+# Geometry, written last: the volume is only read if this file exists
+METADATA_FILE = "volume.json"
+FORMAT_VERSION = 1
+
+'''
+Description: Files of a level of the volume pyramid, see render/pyramid.py. The level is its
+    downsampling factor, level 1 is the volume as loaded.
+Return: (voxels file, metadata file)
+'''
+def cacheFiles(level: int = 1) -> Tuple[str, str]:
+    if level == 1:
+        return VOLUME_FILE, METADATA_FILE
+    return f"volume.{level}.npy", f"volume.{level}.json"
+
+'''
+Description: Wrap a (z, y, x) array into a vtkImageData without copying it.
+'''
+def imageDataFromArray(
+        array: np.ndarray,
+        spacing: List[float],
+        origin: List[float],
+        direction: List[float]
+    ) -> vtk.vtkImageData:
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+    imageData.SetSpacing(spacing)
+    imageData.SetOrigin(origin)
+    imageData.SetDirectionMatrix(direction)
+    # The vtk array keeps a reference to the numpy array
+    imageData.GetPointData().SetScalars(numpy_to_vtk(array.reshape(-1), deep=False))
+    return imageData
+
+'''
+Description: Save a loaded volume next to the DICOM files of a series, so that opening
+    the series again maps the voxels instead of parsing every instance.
+    Both files are written under a temporary name of the process then renamed, so a reader
+    never sees a partial file. A published series must be held locked, see SeriesCache.extend.
+    Errors are logged, the cache is only an optimization.
+'''
+def writeVolume(seriesPath: str, imageData: vtk.vtkImageData, level: int = 1) -> None:
+    dimensions = imageData.GetDimensions()
+    array = vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(tuple(reversed(dimensions)))
+    directionMatrix = imageData.GetDirectionMatrix()
+    metadata = {
+        "version": FORMAT_VERSION,
+        "dimensions": list(dimensions),
+        "dtype": array.dtype.str,
+        "spacing": list(imageData.GetSpacing()),
+        "origin": list(imageData.GetOrigin()),
+        "direction": [directionMatrix.GetElement(row, col) for row in range(3) for col in range(3)]
+    }
+    volumeFile, metadataFile = cacheFiles(level)
+    try:
+        for name, write in (
+            (volumeFile, lambda file: np.save(file, array)),
+            (metadataFile, lambda file: file.write(json.dumps(metadata).encode()))
+        ):
+            path = os.path.join(seriesPath, name)
+            tmpPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmpPath, "wb") as file:
+                write(file)
+            os.replace(tmpPath, path)
+    except OSError as e:
+        logging.error(f"Volume cache of {seriesPath}: {e}")
+
+'''
+Description: Memory map the volume saved by writeVolume.
+Params:
+    mmapMode: "r" for a read-only volume, "c" for copy-on-write, the file is never modified
+    level: level of the volume pyramid
+Return: None if the series has no volume cache
+'''
+def readVolume(seriesPath: str, mmapMode: str = "c", level: int = 1) -> Optional[vtk.vtkImageData]:
+    volumeFile, metadataFile = cacheFiles(level)
+    try:
+        with open(os.path.join(seriesPath, metadataFile), "r") as file:
+            metadata = json.load(file)
+        if metadata.get("version") != FORMAT_VERSION:
+            return None
+        array = np.load(os.path.join(seriesPath, volumeFile), mmap_mode=mmapMode)
+    except (OSError, ValueError) as e:
+        logging.info(f"No volume cache in {seriesPath}: {e}")
+        return None
+
+    if list(reversed(array.shape)) != metadata["dimensions"] or array.dtype.str != metadata["dtype"]:
+        logging.error(f"Volume cache of {seriesPath} does not match its metadata")
+        return None
+    return imageDataFromArray(array, metadata["spacing"], metadata["origin"], metadata["direction"])
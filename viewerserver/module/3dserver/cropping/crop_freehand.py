@@ -1,17 +1,23 @@
 import vtk
-from vtkmodules.vtkCommonCore import vtkMath, vtkCommand
-from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+from vtkmodules.vtkCommonCore import vtkCommand
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk, numpy_to_vtkIdTypeArray, ID_TYPE_CODE
+
+import numpy as np
 
 from enum import Enum
-from typing import Tuple
-import logging, gc
+from typing import List, Optional, Tuple
+import logging, gc, math
 
-from cropping.utils import calcClipRange, GetImageToWorldMatrix, GetImageToWorldMatrix, SetImageToWorldMatrix, modifyImage
+from cropping.utils import calcClipRange, GetImageToWorldMatrix
+from cropping.volume_edits import VolumeEdits, boundingBox
 from measurement.utils import AfterInteractorStyle
 from utils.utils import getInfoMemory
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+# numpy type of vtkIdType, for building cell arrays in bulk
+ID_TYPE = np.dtype(ID_TYPE_CODE)
+
 class Operation(Enum): 
     INSIDE=1,
     OUTSIDE=2
@@ -59,7 +65,7 @@ class CropFreehandInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
             self, 
             contour2Dpipeline: Contour2DPipeline, 
             imageData: vtk.vtkImageData, 
-            mask: vtk.vtkImageData, 
+            volumeEdits: VolumeEdits, 
             operation: Operation,
             fillValue: int,
             afterInteractorStyle: AfterInteractorStyle
@@ -68,8 +74,8 @@ class CropFreehandInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
         self.contour2Dpipeline = contour2Dpipeline
         # Origin image data
         self.imageData = imageData
-        # Image data extends some properties from origin image data such as: extent, origin, spacing, direction and scalar type
-        self.mask = mask
+        # Cropped voxels are changed through it, so that they can be restored
+        self.volumeEdits = volumeEdits
         # operation: INSIDE or OUTSIDE
         self.operation = operation
         # Fill value
@@ -201,29 +207,21 @@ class CropFreehandInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
         segmentationToWorldMatrix = vtk.vtkMatrix4x4()
         segmentationToWorldMatrix.Identity()
 
-        closedSurfacePoints = vtk.vtkPoints()
-
-        # 6058 MB
-        
         # Camera parameters
         # Camera position
-        cameraPos = list(camera.GetPosition())
-        cameraPos.append(1)
+        cameraPos = np.array(camera.GetPosition())
         # Focal point
-        cameraFP = list(camera.GetFocalPoint())
-        cameraFP.append(1)
+        cameraFP = np.array(camera.GetFocalPoint())
         # Direction of projection
-        cameraDOP = [0, 0, 0]
-        for i in range(3):
-            cameraDOP[i] = cameraFP[i] - cameraPos[i]
-        vtkMath.Normalize(cameraDOP)
+        cameraDOP = cameraFP - cameraPos
+        cameraDOP /= np.linalg.norm(cameraDOP)
         # Camera view up
-        cameraViewUp = list(camera.GetViewUp())
-        vtkMath.Normalize(cameraViewUp)
+        cameraViewUp = np.array(camera.GetViewUp())
+        cameraViewUp /= np.linalg.norm(cameraViewUp)
 
         # 6058 MB
         
-        renderer.SetWorldPoint(cameraFP[0], cameraFP[1], cameraFP[2], cameraFP[3])
+        renderer.SetWorldPoint(cameraFP[0], cameraFP[1], cameraFP[2], 1)
         renderer.WorldToDisplay()
         displayCoords = renderer.GetDisplayPoint()
         selectionZ = displayCoords[2]
@@ -232,114 +230,90 @@ class CropFreehandInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
 
         # Get modifier labelmap extent in camera coordinates to know how much we have to cut through
         cameraToWorldMatrix = vtk.vtkMatrix4x4()
-        cameraViewRight = [1, 0, 0]
-        vtkMath.Cross(cameraDOP, cameraViewUp, cameraViewRight) # Tich co huong
+        cameraViewRight = np.cross(cameraDOP, cameraViewUp) # Tich co huong
         for i in range(3):
             cameraToWorldMatrix.SetElement(i, 0, cameraViewUp[i])
             cameraToWorldMatrix.SetElement(i, 1, cameraViewRight[i])
             cameraToWorldMatrix.SetElement(i, 2, cameraDOP[i])
             cameraToWorldMatrix.SetElement(i, 3, cameraPos[i])
         # cameraToWorldMatrix = [cameraViewUp cameraViewRight cameraDOP cameraPos]
-        # print(cameraToWorldMatrix)
-
-        # 6058 MB
 
         worldToCameraMatrix = vtk.vtkMatrix4x4()
         vtk.vtkMatrix4x4().Invert(cameraToWorldMatrix, worldToCameraMatrix)
-        # print(worldToCameraMatrix)
-
-        # 6058 MB
 
         segmentationToCameraTransform = vtk.vtkTransform()
         segmentationToCameraTransform.Concatenate(worldToCameraMatrix)
         segmentationToCameraTransform.Concatenate(segmentationToWorldMatrix)
-        # print(segmentationToCameraTransform)
 
         # 6058 MB
 
         if self.clippingRange is None:
-            self.clippingRange = calcClipRange(self.mask, segmentationToCameraTransform, camera)
+            self.clippingRange = calcClipRange(self.imageData, segmentationToCameraTransform, camera)
             # 6058 MB
-        
-        for pointIndex in range(numberOfPoints):
-            # Convert the selection point into world coordinates
-            pointXY = pointsXY.GetPoint(pointIndex)
-            renderer.SetDisplayPoint(pointXY[0], pointXY[1], selectionZ)
+
+        # Convert the selection points into world coordinates.
+        # At a fixed display depth, display to world is affine in x and y for both projections
+        # (the homogeneous w only depends on the depth), so three points give the whole mapping.
+        anchors = []
+        for displayX, displayY in ((0, 0), (1, 0), (0, 1)):
+            renderer.SetDisplayPoint(displayX, displayY, selectionZ)
             renderer.DisplayToWorld()
             worldCoords = renderer.GetWorldPoint()
             if worldCoords[3] == 0:
                 # print("Bad homogeneous coordinates")
                 logging.info("Bad homogeneous coordinates - __updateBrushModel() function - cropping freehand tool")
                 return False
-            
             # Convert from homo coordinates to world coordinates
-            pickPosition = [0, 0, 0]
-            for i in range(3):
-                pickPosition[i] = worldCoords[i] / worldCoords[3]
-
-            # Compute the ray endpoints. The ray is along the line running from
-            # the camera position to the selection point, starting where this line
-            # intersects the front clipping plane, and terminating where this line
-            # intersects the back clipping plane.
-            ray = [0, 0, 0]
-            for i in range(3):
-                ray[i] = pickPosition[i] - cameraPos[i] # vector
-            rayLength = vtk.vtkMath().Dot(cameraDOP, ray)
-            if rayLength == 0:
-                # print("Cannot process points")
-                logging.error("Cannot process points - __updateBrushModel() function - cropping freehand tool")
-                return False
-
-            # Finding a point on the near clipping plane and a point on the far clipping plane 
-            # (two points in world coordinates)
-            p1World = [0, 0, 0]
-            p2World = [0, 0, 0]
-            tF = 0
-            tB = 0
-            if camera.GetParallelProjection():
-                tF = self.clippingRange[0] - rayLength
-                tB = self.clippingRange[1] - rayLength
-                for i in range(3):
-                    p1World[i] = pickPosition[i] + tF * cameraDOP[i]
-                    p2World[i] = pickPosition[i] + tB * cameraDOP[i]
-            else:
-                tF = self.clippingRange[0] / rayLength
-                tB = self.clippingRange[1] / rayLength
-                for i in range(3):
-                    p1World[i] = cameraPos[i] + tF * ray[i]
-                    p2World[i] = cameraPos[i] + tB * ray[i]
-                closedSurfacePoints.InsertNextPoint(p1World)
-                closedSurfacePoints.InsertNextPoint(p2World)
+            anchors.append(np.array(worldCoords[:3]) / worldCoords[3])
+        displayXY = vtk_to_numpy(pointsXY.GetData())[:, :2].astype(np.float64)
+        pickPositions = anchors[0] + displayXY[:, 0:1] * (anchors[1] - anchors[0]) + displayXY[:, 1:2] * (anchors[2] - anchors[0])
+
+        # Compute the ray endpoints. The ray is along the line running from
+        # the camera position to the selection point, starting where this line
+        # intersects the front clipping plane, and terminating where this line
+        # intersects the back clipping plane.
+        rays = pickPositions - cameraPos # vectors
+        rayLengths = rays @ cameraDOP
+        if np.any(rayLengths == 0):
+            # print("Cannot process points")
+            logging.error("Cannot process points - __updateBrushModel() function - cropping freehand tool")
+            return False
+
+        # Finding a point on the near clipping plane and a point on the far clipping plane 
+        # (two points in world coordinates), interleaved: near, far, near, far...
+        closedSurfacePointsArray = np.empty((numberOfPoints * 2, 3))
+        if camera.GetParallelProjection():
+            tF = self.clippingRange[0] - rayLengths
+            tB = self.clippingRange[1] - rayLengths
+            closedSurfacePointsArray[0::2] = pickPositions + tF[:, np.newaxis] * cameraDOP
+            closedSurfacePointsArray[1::2] = pickPositions + tB[:, np.newaxis] * cameraDOP
+        else:
+            tF = self.clippingRange[0] / rayLengths
+            tB = self.clippingRange[1] / rayLengths
+            closedSurfacePointsArray[0::2] = cameraPos + tF[:, np.newaxis] * rays
+            closedSurfacePointsArray[1::2] = cameraPos + tB[:, np.newaxis] * rays
+        closedSurfacePoints = vtk.vtkPoints()
+        closedSurfacePoints.SetData(numpy_to_vtk(closedSurfacePointsArray, deep=True))
 
         # 6058 MB
 
-        # Skirt
+        # Skirt: a single strip through every point, closed by the first two points again
         closedSurfaceStrips = vtk.vtkCellArray() # object to represent cell connectivity
-        # Create cells by specifying a count of total points to be inserted,
-        # and then adding points one at a time using method InsertCellPoint()
-        closedSurfaceStrips.InsertNextCell(numberOfPoints * 2 + 2)
-        for i in range(numberOfPoints * 2):
-            closedSurfaceStrips.InsertCellPoint(i)
-        closedSurfaceStrips.InsertCellPoint(0)
-        closedSurfaceStrips.InsertCellPoint(1)
-
-        # 6059 MB
+        closedSurfaceStrips.SetData(
+            numpy_to_vtkIdTypeArray(np.array([0, numberOfPoints * 2 + 2], dtype=ID_TYPE), deep=True),
+            numpy_to_vtkIdTypeArray(np.concatenate((np.arange(numberOfPoints * 2, dtype=ID_TYPE), np.array([0, 1], dtype=ID_TYPE))), deep=True)
+        )
 
-        # Front cap
+        # Front cap with the near points, back cap with the far points
         closedSurfacePolys = vtk.vtkCellArray() # object to represent cell connectivity
-        closedSurfacePolys.InsertNextCell(numberOfPoints)
-        for i in range(numberOfPoints):
-            closedSurfacePolys.InsertCellPoint(i * 2)
-
-        # Back cap
-        closedSurfacePolys.InsertNextCell(numberOfPoints)
-        for i in range(numberOfPoints):
-            closedSurfacePolys.InsertCellPoint(i * 2 + 1)
+        closedSurfacePolys.SetData(
+            numpy_to_vtkIdTypeArray(np.array([0, numberOfPoints, numberOfPoints * 2], dtype=ID_TYPE), deep=True),
+            numpy_to_vtkIdTypeArray(np.concatenate((np.arange(0, numberOfPoints * 2, 2, dtype=ID_TYPE), np.arange(1, numberOfPoints * 2, 2, dtype=ID_TYPE))), deep=True)
+        )
 
         # 6059 MB
         
         # Construct polydata
-        # closedSurfacePolyData = self.contour2Dpipeline.polyData3D
         closedSurfacePolyData = vtk.vtkPolyData()
         closedSurfacePolyData.SetPoints(closedSurfacePoints)
         closedSurfacePolyData.SetStrips(closedSurfaceStrips)
@@ -354,20 +328,21 @@ class CropFreehandInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
     '''
     Description:
         Using a transform matrix to convert from world coordinates to model (image) coordinates.
-        Set bounds for image stencil with two cases: INSIDE or OUTSIDE
+        The stencil only covers the bounding box of the brush, not the whole volume.
+    Return: extent of the brush in voxel indices, clipped to the volume, None if they do not intersect
     '''
     def __updateBrushStencil(
             self, 
             worldToModifierLabelmapIjkTransform: vtk.vtkTransform, 
             worldToModifierLabelmapIjkTransformer: vtk.vtkTransformPolyDataFilter, 
             brushPolyDataToStencil: vtk.vtkPolyDataToImageStencil
-        ) -> None:
+        ) -> Optional[List[int]]:
         # 6060 MB logging.info(f"CropFreehandInteractorStyle class - __updateBrushStencil() - Used Memory: {GetInfoMemory()}MB")
 
         worldToModifierLabelmapIjkTransform.Identity()
 
         segmentationToSegmentationIjkTransformMatrix = vtk.vtkMatrix4x4()
-        GetImageToWorldMatrix(self.mask, segmentationToSegmentationIjkTransformMatrix)
+        GetImageToWorldMatrix(self.imageData, segmentationToSegmentationIjkTransformMatrix)
         segmentationToSegmentationIjkTransformMatrix.Invert()
         worldToModifierLabelmapIjkTransform.Concatenate(segmentationToSegmentationIjkTransformMatrix)
 
@@ -383,14 +358,23 @@ class CropFreehandInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
 
         # 6060 MB logging.info(f"CropFreehandInteractorStyle class - __updateBrushStencil() - Used Memory: {GetInfoMemory()}MB")
 
-        brushPolyDataToStencil.SetOutputWholeExtent(self.mask.GetExtent())
+        bounds = worldToModifierLabelmapIjkTransformer.GetOutput().GetBounds()
+        imageExtent = self.imageData.GetExtent()
+        brushExtent = []
+        for axis in range(3):
+            brushExtent.append(max(imageExtent[axis * 2], math.floor(bounds[axis * 2])))
+            brushExtent.append(min(imageExtent[axis * 2 + 1], math.ceil(bounds[axis * 2 + 1])))
+            if brushExtent[axis * 2] > brushExtent[axis * 2 + 1]:
+                return None
+        brushPolyDataToStencil.SetOutputWholeExtent(brushExtent)
 
         # 6060 MB logging.info(f"CropFreehandInteractorStyle class - __updateBrushStencil() - Used Memory: {GetInfoMemory()}MB")
+        return brushExtent
 
     '''
     Description: 
-        Convert from image stencil to image data, set cropped region equal 1.
-        Set spacing, origin and direction.
+        Rasterize the brush in its bounding box and fill the cropped voxels in place:
+        inside the brush for INSIDE, everywhere else for OUTSIDE.
     '''
     def __paintApply(self) -> None:
         # 6059 MB
@@ -411,72 +395,49 @@ class CropFreehandInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
         if not self.__updateBrushModel(brushPolyDataNormals):
             return
         
-        self.__updateBrushStencil(worldToModifierLabelmapIjkTransform, worldToModifierLabelmapIjkTransformer, brushPolyDataToStencil)
+        brushExtent = self.__updateBrushStencil(worldToModifierLabelmapIjkTransform, worldToModifierLabelmapIjkTransformer, brushPolyDataToStencil)
 
         # 6060 MB
 
-        brushPolyDataToStencil.Update()
-
-        # 6068 MB
-    
-        # vtkImageStencilToImage will convert an image stencil into a binary image
-        # The default output will be an 8-bit image with a value of 1 inside the stencil and 0 outside
-        stencilToImage = vtk.vtkImageStencilToImage()
-        stencilToImage.SetInputData(brushPolyDataToStencil.GetOutput())
-
-        stencilToImage.SetInsideValue(self.operation == Operation.INSIDE)
-        stencilToImage.SetOutsideValue(self.operation != Operation.INSIDE)
-
-        # stencilToImage.SetOutputScalarType(self.mask.GetScalarType()) # vtk.VTK_SHORT: [-32768->32767], vtk.VTK_UNSIGNED_CHAR: [0->255]
-        stencilToImage.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
-        stencilToImage.Update()
-
-        # 6337 MB
-
-        # orientedBrushPositionerOutput = vtk.vtkImageData()
-        # orientedBrushPositionerOutput.DeepCopy(stencilToImage.GetOutput())
-        orientedBrushPositionerOutput = stencilToImage.GetOutput()
-
-        # 6337 MB
-
-        imageToWorld = vtk.vtkMatrix4x4()
-        GetImageToWorldMatrix(self.mask, imageToWorld)
-
-        # 6338 MB
-
-        SetImageToWorldMatrix(orientedBrushPositionerOutput, imageToWorld)
-
-        # 6337 MB
-
-        modifyImage(self.mask, orientedBrushPositionerOutput)
+        insideBrush = None
+        if brushExtent is not None:
+            brushPolyDataToStencil.Update()
+
+            # 6068 MB
+
+            # vtkImageStencilToImage will convert an image stencil into a binary image
+            # The default output will be an 8-bit image with a value of 1 inside the stencil and 0 outside
+            stencilToImage = vtk.vtkImageStencilToImage()
+            stencilToImage.SetInputData(brushPolyDataToStencil.GetOutput())
+            stencilToImage.SetInsideValue(1)
+            stencilToImage.SetOutsideValue(0)
+            stencilToImage.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
+            stencilToImage.Update()
+
+            # Voxels inside the brush, the stencil only covers the brush extent
+            x0, x1, y0, y1, z0, z1 = brushExtent
+            brushBox = (z0, z1 + 1, y0, y1 + 1, x0, x1 + 1)
+            shape = (z1 - z0 + 1, y1 - y0 + 1, x1 - x0 + 1) # (z, y, x)
+            insideBrush = vtk_to_numpy(stencilToImage.GetOutput().GetPointData().GetScalars()).reshape(shape) > 0
+
+        if self.operation == Operation.INSIDE:
+            box = None if insideBrush is None else boundingBox(insideBrush)
+            if box is not None:
+                # Shrink to the voxels actually inside, then offset to volume indices
+                z0, z1, y0, y1, x0, x1 = box
+                mask = insideBrush[z0:z1, y0:y1, x0:x1]
+                box = (brushBox[0] + z0, brushBox[0] + z1, brushBox[2] + y0, brushBox[2] + y1, brushBox[4] + x0, brushBox[4] + x1)
+                self.volumeEdits.fill(box, mask, self.fillValue)
+        else:
+            # Everything but the inside of the brush
+            shape = tuple(reversed(self.imageData.GetDimensions())) # (z, y, x)
+            mask = np.ones(shape, dtype=bool)
+            if insideBrush is not None:
+                z0, z1, y0, y1, x0, x1 = brushBox
+                mask[z0:z1, y0:y1, x0:x1] = ~insideBrush
+            self.volumeEdits.fill((0, shape[0], 0, shape[1], 0, shape[2]), mask, self.fillValue)
 
         # 6337 MB
 
-        self.__maskVolume()
-
         collected = gc.collect()
         logging.info(f"Collected {collected} objects")
-
-    '''
-    Description: Apply the mask for volume and render the new volume
-        Hard edge: CT-Bone, CT-Angio
-        Soft edge: CT-Muscle, CT-Mip
-    '''
-    def __maskVolume(self) -> None:
-        shape = tuple(reversed(self.imageData.GetDimensions())) # (z, y, x)
-        imageDataArray = vtk_to_numpy(self.imageData.GetPointData().GetScalars()).reshape(shape)
-        
-        # 6337 MB
-
-        # Convert binary mask image and origin image data from vtkDataArray (supper class) to numpy
-        maskArray = vtk_to_numpy(self.mask.GetPointData().GetScalars()).reshape(shape)
-
-        # 6337 MB
-        
-        imageDataArray[maskArray > 0] = self.fillValue
-
-        # 6339 MB
-
-        self.imageData.GetPointData().SetScalars(numpy_to_vtk(imageDataArray.reshape(1, -1)[0]))
-        
-        # 6339 MB
\ No newline at end of file
@@ -148,31 +148,6 @@ def calcClipRange(
     ]
     return clipRange
 
-'''
-Description:
-Set scalar values for baseImage
-baseImage and modifierImage must have the same geometry (origin, spacing, directions)
-and scalar type.
-''' 
-def modifyImage(
-        baseImage: vtk.vtkImageData, 
-        modifierImage: vtk.vtkImageData
-    ) -> None:
-    # 6337 MB
-
-    sourceArray = vtk_to_numpy(modifierImage.GetPointData().GetScalars())
-    targetArray = vtk_to_numpy(baseImage.GetPointData().GetScalars())
-
-    # 6337 MB
-
-    targetArray[sourceArray > 0] = 1
-
-    # 6337 MB
-
-    baseImage.GetPointData().SetScalars(numpy_to_vtk(targetArray))
-
-    # 6337 MB
-
 def gaussianFilter(
         imageData: vtk.vtkImageData, 
         softEdgeMm: float
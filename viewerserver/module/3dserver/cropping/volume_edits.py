@@ -0,0 +1,174 @@
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+import numpy as np
+
+import zlib
+import logging
+from typing import Callable, List, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Memory the crop history may use, compressed
+HISTORY_MAX_BYTES = 512 * 1024 * 1024
+# Fast zlib level, the masks compress well at any level
+COMPRESSION_LEVEL = 1
+
+# Bounding box of an edit in voxel indices: (z0, z1, y0, y1, x0, x1), upper bounds excluded
+Box = Tuple[int, int, int, int, int, int]
+
+'''
+Description: Smallest box holding every non zero voxel of a (z, y, x) mask.
+Return: None if the mask is empty
+'''
+def boundingBox(mask: np.ndarray) -> Optional[Box]:
+    box = []
+    for axes in ((1, 2), (0, 2), (0, 1)):
+        indices = np.flatnonzero(mask.any(axis=axes))
+        if indices.size == 0:
+            return None
+        box += [int(indices[0]), int(indices[-1]) + 1]
+    return tuple(box)
+
+'''
+Description: Voxels changed by one edit: their bounding box, which voxels of the box changed
+    as a packed bit mask, their values before the change and the value they were set to.
+    The mask and the values are kept zlib compressed.
+'''
+class VolumeEdit():
+    __slots__ = ["box", "shape", "dtype", "packedMask", "values", "value"]
+    def __init__(self, box: Box, changed: np.ndarray, values: np.ndarray, value: float) -> None:
+        self.box = box
+        self.shape = changed.shape
+        self.dtype = values.dtype
+        self.packedMask = zlib.compress(np.packbits(changed, axis=None).tobytes(), COMPRESSION_LEVEL)
+        self.values = zlib.compress(values.tobytes(), COMPRESSION_LEVEL)
+        self.value = value
+
+    def changed(self) -> np.ndarray:
+        packedMask = np.frombuffer(zlib.decompress(self.packedMask), dtype=np.uint8)
+        count = int(np.prod(self.shape))
+        return np.unpackbits(packedMask, count=count).reshape(self.shape).astype(bool)
+
+    def oldValues(self) -> np.ndarray:
+        return np.frombuffer(zlib.decompress(self.values), dtype=self.dtype)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.packedMask) + len(self.values)
+
+'''
+Description: Undo/redo history of the edits of a volume, changed in place. Only the voxels an
+    edit changes are kept, so the volume as loaded can be restored without keeping a copy of it.
+    A voxel which already has the new value is not recorded, so cropping the same
+    region again costs nothing.
+    Above maxBytes the oldest edits are dropped, redo first. An undo edit is only dropped if
+    the volume as loaded can be read from pristine (the read-only volume cache), its box is
+    then restored from there on reset. The latest edit can always be undone.
+'''
+class VolumeEdits():
+    def __init__(
+            self,
+            imageData: vtk.vtkImageData,
+            maxBytes: int = HISTORY_MAX_BYTES,
+            pristine: Optional[vtk.vtkImageData] = None
+        ) -> None:
+        self.imageData = imageData
+        self.maxBytes = maxBytes
+        self.undoStack: List[VolumeEdit] = []
+        self.redoStack: List[VolumeEdit] = []
+        # Boxes of the dropped edits, restored from pristine on reset
+        self.pristineBoxes: List[Box] = []
+        # Called with the boxes changed by every fill, undo, redo and restore
+        self.observers: List[Callable[[List[Box]], None]] = []
+
+        self.pristine = None
+        if pristine is not None and pristine.GetDimensions() == imageData.GetDimensions():
+            array = vtk_to_numpy(pristine.GetPointData().GetScalars()).reshape(self.__array().shape)
+            if array.dtype == self.__array().dtype:
+                self.pristine = array
+
+    def __array(self) -> np.ndarray:
+        shape = tuple(reversed(self.imageData.GetDimensions())) # (z, y, x)
+        return vtk_to_numpy(self.imageData.GetPointData().GetScalars()).reshape(shape)
+
+    @staticmethod
+    def __region(array: np.ndarray, box: Box) -> np.ndarray:
+        z0, z1, y0, y1, x0, x1 = box
+        return array[z0:z1, y0:y1, x0:x1]
+
+    def addObserver(self, callback: Callable[[List[Box]], None]) -> None:
+        self.observers.append(callback)
+
+    def __modified(self, boxes: List[Box]) -> None:
+        self.imageData.GetPointData().GetScalars().Modified()
+        for callback in self.observers:
+            callback(boxes)
+
+    def fill(self, box: Box, mask: np.ndarray, value: float) -> bool:
+        '''
+        Description: Set the voxels of the box selected by mask to value.
+        Return: False if no voxel changed
+        '''
+        region = self.__region(self.__array(), box)
+        changed = mask & (region != value)
+        if not changed.any():
+            return False
+        self.undoStack.append(VolumeEdit(box, changed, region[changed], value))
+        self.redoStack.clear()
+        region[changed] = value
+        self.__limitHistory()
+        self.__modified([box])
+        return True
+
+    def undo(self) -> bool:
+        if not self.undoStack:
+            return False
+        edit = self.undoStack.pop()
+        region = self.__region(self.__array(), edit.box)
+        region[edit.changed()] = edit.oldValues()
+        self.redoStack.append(edit)
+        self.__modified([edit.box])
+        return True
+
+    def redo(self) -> bool:
+        if not self.redoStack:
+            return False
+        edit = self.redoStack.pop()
+        region = self.__region(self.__array(), edit.box)
+        region[edit.changed()] = edit.value
+        self.undoStack.append(edit)
+        self.__modified([edit.box])
+        return True
+
+    def restoreAll(self) -> None:
+        if not self.undoStack and not self.pristineBoxes:
+            self.redoStack.clear()
+            return
+        array = self.__array()
+        boxes = [edit.box for edit in self.undoStack] + self.pristineBoxes
+        # Latest first, a voxel changed twice gets back its value from the first edit
+        for edit in reversed(self.undoStack):
+            region = self.__region(array, edit.box)
+            region[edit.changed()] = edit.oldValues()
+        for box in self.pristineBoxes:
+            self.__region(array, box)[...] = self.__region(self.pristine, box)
+        self.undoStack.clear()
+        self.redoStack.clear()
+        self.pristineBoxes.clear()
+        self.__modified(boxes)
+
+    def __limitHistory(self) -> None:
+        while self.nbytes > self.maxBytes:
+            if self.redoStack:
+                # The edit undone first is the furthest from the current state
+                self.redoStack.pop(0)
+            elif len(self.undoStack) > 1 and self.pristine is not None:
+                self.pristineBoxes.append(self.undoStack.pop(0).box)
+            else:
+                logging.warning(f"Crop history uses {self.nbytes} bytes, above the {self.maxBytes} bytes limit")
+                return
+
+    @property
+    def nbytes(self) -> int:
+        return sum(edit.nbytes for edit in self.undoStack) + sum(edit.nbytes for edit in self.redoStack)
@@ -0,0 +1,109 @@
+from enum import Enum
+from typing import BinaryIO, Callable, Dict, Optional
+
+class _State(Enum):
+    PREAMBLE = 1
+    DELIMITER = 2
+    HEADERS = 3
+    BODY = 4
+    DONE = 5
+
+'''
+Description: Get the boundary parameter of a multipart Content-Type header.
+Return: the boundary as bytes, None if the content type is not multipart
+'''
+def getBoundary(contentType: str) -> Optional[bytes]:
+    mediaType, *params = contentType.split(";")
+    if not mediaType.strip().lower().startswith("multipart/"):
+        return None
+    for param in params:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "boundary":
+            return value.strip().strip('"').encode()
+    return None
+
+'''
+Description: Incremental parser for a multipart/related body (RFC 2046).
+    The body is fed chunk by chunk, each part body is written to the file returned by
+    openPart(headers) and closePart() is called once the part is complete.
+    At most one delimiter's worth of data is buffered, whatever the size of a part.
+'''
+class MultipartStreamParser():
+    def __init__(
+            self,
+            boundary: bytes,
+            openPart: Callable[[Dict[str, str]], BinaryIO],
+            closePart: Callable[[], None]
+        ) -> None:
+        self.delimiter = b"\r\n--" + boundary
+        # The first delimiter is not preceded by a CRLF
+        self.buffer = b"\r\n"
+        self.state = _State.PREAMBLE
+        self.openPart = openPart
+        self.closePart = closePart
+        self.file = None
+
+    @property
+    def done(self) -> bool:
+        return self.state == _State.DONE
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+        while True:
+            if self.state == _State.PREAMBLE:
+                index = self.buffer.find(self.delimiter)
+                if index < 0:
+                    self.buffer = self.buffer[-(len(self.delimiter) - 1):]
+                    return
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                self.state = _State.DELIMITER
+
+            elif self.state == _State.DELIMITER:
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer.startswith(b"--"):
+                    # Close delimiter, anything after it is epilogue
+                    self.buffer = b""
+                    self.state = _State.DONE
+                    return
+                # Skip transport padding up to the end of the delimiter line
+                index = self.buffer.find(b"\r\n")
+                if index < 0:
+                    return
+                self.buffer = self.buffer[index + 2:]
+                self.state = _State.HEADERS
+
+            elif self.state == _State.HEADERS:
+                if self.buffer.startswith(b"\r\n"):
+                    rawHeaders = b""
+                    self.buffer = self.buffer[2:]
+                else:
+                    index = self.buffer.find(b"\r\n\r\n")
+                    if index < 0:
+                        return
+                    rawHeaders = self.buffer[:index]
+                    self.buffer = self.buffer[index + 4:]
+                headers = {}
+                for line in rawHeaders.decode("latin-1").split("\r\n"):
+                    name, _, value = line.partition(":")
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+                self.file = self.openPart(headers)
+                self.state = _State.BODY
+
+            elif self.state == _State.BODY:
+                index = self.buffer.find(self.delimiter)
+                if index < 0:
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        self.file.write(self.buffer[:-keep])
+                        self.buffer = self.buffer[-keep:]
+                    return
+                self.file.write(self.buffer[:index])
+                self.file = None
+                self.closePart()
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                self.state = _State.DELIMITER
+
+            else:
+                return
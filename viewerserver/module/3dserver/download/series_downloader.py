@@ -0,0 +1,226 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+import os
+import queue
+import threading
+import time
+import logging
+from typing import BinaryIO, Callable, Dict, List, Optional
+
+from pydicom import dcmread
+
+from download.multipart import MultipartStreamParser, getBoundary
+from utils.utils import MyAuth
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Status codes worth another attempt (throttling, gateway and server errors)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+'''
+Description: Download every instance of a series into a directory.
+    Workers pull the next instance from a shared queue, so a slow instance only delays
+    the worker fetching it instead of a whole pre-assigned chunk. All workers share one
+    requests.Session, whose connection pool keeps the connections to the store alive.
+    Failed requests are retried with exponential backoff.
+    downloadSeries() pulls the whole series in one WADO-RS request instead.
+    onInstance(objectUID, path) is called from the downloading thread once an instance is on disk.
+'''
+class SeriesDownloader():
+    def __init__(
+            self,
+            store: Dict,
+            studyUID: str,
+            seriesUID: str,
+            dicomDataPath: str,
+            workers: int = 8,
+            retries: int = 3,
+            backoff: float = 0.5,
+            onInstance: Optional[Callable[[str, str], None]] = None
+        ) -> None:
+        self.store = store
+        self.studyUID = studyUID
+        self.seriesUID = seriesUID
+        self.dicomDataPath = dicomDataPath
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.onInstance = onInstance
+
+        self.session = requests.Session()
+        self.session.auth = MyAuth(store["store_authentication"])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def objectUID(metadata: Dict) -> str:
+        # (0008,0018) SOP Instance UID, read directly instead of building a whole Dataset
+        return metadata["00080018"]["Value"][0]
+
+    @property
+    def wadoUriUrl(self) -> str:
+        # http://host/orthanc/wado-rs -> http://host/orthanc/wado
+        storeUrl = self.store["store_url"]
+        return storeUrl[:-len("-rs")] if storeUrl.endswith("-rs") else storeUrl
+
+    def close(self) -> None:
+        self.session.close()
+
+    def get(self, url: str, **kwargs) -> Optional[requests.Response]:
+        '''
+        Description: GET with retry and exponential backoff on connection errors and retryable status codes.
+        Return: the last response, None if no response was received
+        '''
+        response = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.RequestException as e:
+                logging.warning(f"{url} - attempt {attempt + 1}: {e}")
+                response = None
+                continue
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            logging.warning(f"{url} - attempt {attempt + 1}: {response.status_code}")
+            response.close()
+        return response
+
+    def getMetadata(self) -> Optional[List[Dict]]:
+        url = f"{self.store['store_url']}/studies/{self.studyUID}/series/{self.seriesUID}/metadata"
+        response = self.get(url)
+        if response is None or response.status_code != 200:
+            logging.error(f"{url} - {None if response is None else response.status_code}")
+            return None
+        return response.json()
+
+    def downloadSeries(self) -> List[str]:
+        '''
+        Description: Retrieve the whole series with a single WADO-RS request.
+            The multipart/related response is parsed while it is received and every part
+            is written straight to disk, then renamed after its SOP Instance UID.
+        Return: UIDs of the instances which were written, possibly only part of the series
+        '''
+        url = f"{self.store['store_url']}/studies/{self.studyUID}/series/{self.seriesUID}"
+        response = self.get(url, headers={"Accept": 'multipart/related; type="application/dicom"'}, stream=True)
+        if response is None or response.status_code != 200:
+            logging.info(f"{url} - {None if response is None else response.status_code}")
+            return []
+
+        boundary = getBoundary(response.headers.get("Content-Type", ""))
+        if boundary is None:
+            logging.info(f"{url} - not a multipart response")
+            response.close()
+            return []
+
+        received = []
+        part = {}
+
+        def openPart(headers: Dict[str, str]) -> BinaryIO:
+            part["path"] = os.path.join(self.dicomDataPath, f"series-{len(received)}.part")
+            part["file"] = open(part["path"], "wb")
+            return part["file"]
+
+        def closePart() -> None:
+            part.pop("file").close()
+            objectUID = self.__publishPart(part.pop("path"))
+            if objectUID is not None:
+                received.append(objectUID)
+
+        parser = MultipartStreamParser(boundary, openPart, closePart)
+        try:
+            with response:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    parser.feed(chunk)
+                    if parser.done:
+                        break
+        except (requests.RequestException, OSError) as e:
+            logging.error(f"{url}: {e}")
+        finally:
+            if "file" in part:
+                # Interrupted in the middle of a part
+                part.pop("file").close()
+                os.remove(part.pop("path"))
+        return received
+
+    def __publishPart(self, tmpPath: str) -> Optional[str]:
+        try:
+            objectUID = dcmread(tmpPath, stop_before_pixels=True, specific_tags=["SOPInstanceUID"]).SOPInstanceUID
+        except Exception as e:
+            logging.error(f"{tmpPath}: {e}")
+            os.remove(tmpPath)
+            return None
+        path = os.path.join(self.dicomDataPath, f"{objectUID}.dcm")
+        os.replace(tmpPath, path)
+        if self.onInstance is not None:
+            self.onInstance(objectUID, path)
+        return objectUID
+
+    def downloadInstances(self, objectUIDs: List[str]) -> List[str]:
+        '''
+        Description: Download the instances with the worker pool.
+        Return: UIDs of the instances which could not be downloaded
+        '''
+        tasks = queue.Queue()
+        for objectUID in objectUIDs:
+            tasks.put(objectUID)
+
+        failed = []
+        threads = [
+            threading.Thread(target=self.__worker, args=(tasks, failed), name=f"download-{i}")
+            for i in range(min(self.workers, len(objectUIDs)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return failed
+
+    def __worker(self, tasks: queue.Queue, failed: List[str]) -> None:
+        while True:
+            try:
+                objectUID = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if not self.__saveInstance(objectUID):
+                    failed.append(objectUID)
+            except Exception as e:
+                logging.error(f"{objectUID}: {e}")
+                failed.append(objectUID)
+
+    def __saveInstance(self, objectUID: str) -> bool:
+        response = self.get(
+            self.wadoUriUrl,
+            params={
+                "studyUID": self.studyUID,
+                "seriesUID": self.seriesUID,
+                "objectUID": objectUID,
+                "requestType": "WADO",
+                "contentType": "application/dicom"
+            },
+            stream=True
+        )
+        if response is None or response.status_code != 200:
+            logging.info(f"{objectUID} - {None if response is None else response.status_code}")
+            return False
+
+        # Write to a temporary name first so a partially written file is never read as an instance
+        path = os.path.join(self.dicomDataPath, f"{objectUID}.dcm")
+        tmpPath = path + ".part"
+        try:
+            with response, open(tmpPath, "wb") as file:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    file.write(chunk)
+        except (requests.RequestException, OSError) as e:
+            logging.error(f"{objectUID}: {e}")
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return False
+        os.replace(tmpPath, path)
+        if self.onInstance is not None:
+            self.onInstance(objectUID, path)
+        return True
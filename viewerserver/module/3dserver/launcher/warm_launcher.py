@@ -0,0 +1,268 @@
+r"""
+    Launcher keeping a pool of idle, already started 3D server processes.
+    It reads the same configuration file as wslink.launcher and answers the same requests::
+
+        $ python .../launcher/warm_launcher.py .../config.json
+
+    A process of the pool has imported VTK, created its render window and is listening on
+    its port. Claiming it only sends the series to open on its stdin, so the session URL is
+    returned without waiting for a process to start. A process serves one session and exits,
+    the pool is refilled in the background.
+
+    Configuration, in addition to the wslink.launcher one::
+
+        "warm_pool": {
+            "application": "viewer-warm",   <--- app started in --warm mode
+            "size": 4                       <--- idle processes kept ready
+        }
+"""
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import uuid
+import logging
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Printed by vtk_server.py once it applied the series sent on its stdin
+ASSIGNED_LINE = "Session assigned"
+# Seconds before starting a process again after one exited before it was ready, doubled for
+# every failure in a row up to RESPAWN_MAX_DELAY
+RESPAWN_DELAY = 1.0
+RESPAWN_MAX_DELAY = 300.0
+
+class WarmProcess():
+    __slots__ = ["id", "port", "process", "logFile", "ready", "assigned", "fields"]
+    def __init__(self, id: str, port: int, process: asyncio.subprocess.Process, logFile) -> None:
+        self.id = id
+        self.port = port
+        self.process = process
+        self.logFile = logFile
+        self.ready = asyncio.Event()
+        self.assigned = asyncio.Event()
+        self.fields = {}
+
+'''
+Description: Pool of idle 3D server processes, handed out one per session.
+'''
+class WarmPool():
+    def __init__(self, config: Dict) -> None:
+        configuration = config["configuration"]
+        resource = config["resources"][0]
+        warmPool = config["warm_pool"]
+        app = config["apps"][warmPool["application"]]
+
+        self.host = resource["host"]
+        self.freePorts = list(range(resource["port_range"][0], resource["port_range"][1] + 1))
+        self.size = warmPool["size"]
+        self.cmd = app["cmd"]
+        self.readyLine = app["ready_line"]
+        self.timeout = configuration["timeout"]
+        self.logDir = configuration["log_dir"]
+        self.proxyFile = configuration["proxy_file"]
+        self.sessionURL = configuration["sessionURL"]
+        self.responseFields = configuration.get("fields", [])
+
+        self.idle: List[WarmProcess] = []
+        self.starting = 0
+        # Processes in a row which exited before they were ready
+        self.failures = 0
+        self.sessions: Dict[str, WarmProcess] = {}
+
+    async def fill(self) -> None:
+        while len(self.idle) + self.starting < self.size and self.freePorts:
+            self.starting += 1
+            try:
+                process = await self.__spawn()
+                if process is None:
+                    # Started again by __watch, after a delay
+                    break
+                self.idle.append(process)
+            finally:
+                self.starting -= 1
+
+    async def __spawn(self) -> Optional[WarmProcess]:
+        id = uuid.uuid4().hex
+        port = self.freePorts.pop(0)
+        cmd = [arg.replace("${host}", self.host).replace("${port}", str(port)).replace("${id}", id) for arg in self.cmd]
+        logFile = open(os.path.join(self.logDir, f"{id}.txt"), "w")
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        warmProcess = WarmProcess(id, port, process, logFile)
+        asyncio.ensure_future(self.__watch(warmProcess))
+        try:
+            await asyncio.wait_for(warmProcess.ready.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Process {id} did not start within {self.timeout}s")
+            self.__kill(warmProcess)
+            return None
+        return warmProcess
+
+    @staticmethod
+    def __kill(warmProcess: WarmProcess) -> None:
+        if warmProcess.process.returncode is not None:
+            return
+        try:
+            warmProcess.process.kill()
+        except ProcessLookupError:
+            # Exited meanwhile
+            pass
+
+    async def __watch(self, warmProcess: WarmProcess) -> None:
+        # Relay the output of the process to its log file and watch for the expected lines
+        while True:
+            line = await warmProcess.process.stdout.readline()
+            if not line:
+                break
+            text = line.decode(errors="replace")
+            warmProcess.logFile.write(text)
+            warmProcess.logFile.flush()
+            if self.readyLine in text:
+                warmProcess.ready.set()
+                self.failures = 0
+            if ASSIGNED_LINE in text:
+                warmProcess.assigned.set()
+
+        await warmProcess.process.wait()
+        warmProcess.logFile.close()
+        if warmProcess in self.idle:
+            self.idle.remove(warmProcess)
+        if self.sessions.pop(warmProcess.id, None) is not None:
+            self.__writeProxyFile()
+        self.freePorts.append(warmProcess.port)
+        logging.info(f"Process {warmProcess.id} exited with {warmProcess.process.returncode}")
+        if not warmProcess.ready.is_set():
+            # A process failing at startup would otherwise be started again in a loop
+            self.failures += 1
+            delay = min(RESPAWN_MAX_DELAY, RESPAWN_DELAY * 2 ** (self.failures - 1))
+            logging.error(f"Process {warmProcess.id} exited before it was ready, {self.failures} in a row, next one in {delay}s")
+            await asyncio.sleep(delay)
+        asyncio.ensure_future(self.fill())
+
+    def __writeProxyFile(self) -> None:
+        # Rewritten in place, the file may be bind mounted into the apache container
+        with open(self.proxyFile, "w") as file:
+            for id, warmProcess in self.sessions.items():
+                file.write(f"{id} {self.host}:{warmProcess.port}\n")
+
+    async def claim(self, fields: Dict) -> Optional[Dict]:
+        '''
+        Description: Hand an idle process the series of a new session.
+        Return: the session as returned by wslink.launcher, None if no process is available
+        '''
+        warmProcess = None
+        while self.idle:
+            candidate = self.idle.pop(0)
+            if candidate.process.returncode is None:
+                warmProcess = candidate
+                break
+        if warmProcess is None:
+            # Pool exhausted, start one for this session
+            if not self.freePorts:
+                return None
+            warmProcess = await self.__spawn()
+            if warmProcess is None:
+                return None
+        asyncio.ensure_future(self.fill())
+
+        # Random like the secret wslink.launcher passes to --authKey, the process default is well known
+        fields = {**fields, "secret": fields.get("secret") or secrets.token_urlsafe()}
+        assignment = {name: fields.get(name) for name in ("studyUUID", "seriesUUID", "session2D", "secret")}
+        try:
+            warmProcess.process.stdin.write((json.dumps(assignment) + "\n").encode())
+            await warmProcess.process.stdin.drain()
+        except ConnectionError as e:
+            logging.error(f"Process {warmProcess.id} exited before taking the session: {e}")
+            return None
+        try:
+            await asyncio.wait_for(warmProcess.assigned.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Process {warmProcess.id} did not take the session")
+            self.__kill(warmProcess)
+            return None
+
+        warmProcess.fields = fields
+        self.sessions[warmProcess.id] = warmProcess
+        self.__writeProxyFile()
+
+        session = {
+            "id": warmProcess.id,
+            "sessionURL": self.sessionURL.replace("${id}", warmProcess.id)
+        }
+        for name in self.responseFields:
+            if name in fields:
+                session[name] = fields[name]
+        return session
+
+    def stop(self, id: str) -> bool:
+        warmProcess = self.sessions.get(id)
+        if warmProcess is None:
+            return False
+        if warmProcess.process.returncode is None:
+            try:
+                warmProcess.process.terminate()
+            except ProcessLookupError:
+                pass
+        return True
+
+    def close(self) -> None:
+        for warmProcess in self.idle + list(self.sessions.values()):
+            if warmProcess.process.returncode is None:
+                warmProcess.process.terminate()
+
+def createApp(config: Dict) -> web.Application:
+    pool = WarmPool(config)
+    endpoint = config["configuration"]["endpoint"]
+    routes = web.RouteTableDef()
+
+    @routes.post(f"/{endpoint}")
+    async def startSession(request: web.Request) -> web.Response:
+        fields = await request.json()
+        session = await pool.claim(fields)
+        if session is None:
+            return web.json_response({"error": "No 3D server available"}, status=503)
+        return web.json_response(session)
+
+    @routes.get(f"/{endpoint}/{{id}}")
+    async def getSession(request: web.Request) -> web.Response:
+        warmProcess = pool.sessions.get(request.match_info["id"])
+        if warmProcess is None:
+            return web.json_response({"error": "Invalid session"}, status=404)
+        return web.json_response({"id": warmProcess.id, "port": warmProcess.port})
+
+    @routes.delete(f"/{endpoint}/{{id}}")
+    async def stopSession(request: web.Request) -> web.Response:
+        if not pool.stop(request.match_info["id"]):
+            return web.json_response({"error": "Invalid session"}, status=404)
+        return web.json_response({"id": request.match_info["id"]})
+
+    async def onStartup(app: web.Application) -> None:
+        asyncio.ensure_future(pool.fill())
+
+    async def onShutdown(app: web.Application) -> None:
+        pool.close()
+
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(onStartup)
+    app.on_shutdown.append(onShutdown)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="3D Viewer warm launcher")
+    parser.add_argument("config", help="launcher config file")
+    args = parser.parse_args()
+
+    with open(args.config, mode='r') as file:
+        config = json.load(file)
+
+    web.run_app(createApp(config), host=config["configuration"]["host"], port=config["configuration"]["port"])
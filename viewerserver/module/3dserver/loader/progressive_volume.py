@@ -0,0 +1,205 @@
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+
+import numpy as np
+from pydicom import dcmread
+
+import threading
+import logging
+from typing import Dict, List, Optional
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Coarsest pass of the coarse-to-fine download order: every 8th slice first
+COARSE_STRIDE = 8
+
+'''
+Description: Read the values of a tag in a DICOM JSON metadata object.
+Return: the list of values, default if the tag is missing or empty
+'''
+def _values(metadata: Dict, tag: str, default: Optional[List] = None) -> Optional[List]:
+    element = metadata.get(tag)
+    if element is None or not element.get("Value"):
+        return default
+    return element["Value"]
+
+'''
+Description: Order slice indices coarse to fine: every COARSE_STRIDE-th slice, then the slices
+    halfway between them, and so on, so that the whole extent of the volume is covered early.
+'''
+def coarseToFineOrder(count: int, stride: int = COARSE_STRIDE) -> List[int]:
+    order = []
+    seen = set()
+    while stride >= 1:
+        for index in range(0, count, stride):
+            if index not in seen:
+                seen.add(index)
+                order.append(index)
+        stride //= 2
+    return order
+
+'''
+Description: Volume allocated from the series metadata and filled slice by slice while the
+    instances are downloaded, so it can be rendered before the whole series is on disk.
+    A slice which did not arrive yet repeats the closest loaded slice below it, at most
+    COARSE_STRIDE slices away, so a coarse pass already shows the whole object.
+    The geometry follows vtkDICOMImageReader: slices sorted along the normal, rows flipped,
+    origin at the position of the first slice, rescale slope and intercept applied.
+    addSlice() is called from the download threads, the render thread only reads version.
+'''
+class ProgressiveVolume():
+    def __init__(
+            self,
+            objectUIDs: List[str],
+            dimensions: List[int],
+            spacing: List[float],
+            origin: List[float],
+            dtype: np.dtype,
+            fillValue: float
+        ) -> None:
+        self.objectUIDs = objectUIDs
+        self.indexOf = {objectUID: index for index, objectUID in enumerate(objectUIDs)}
+        self.loaded = [False] * len(objectUIDs)
+        self.loadedCount = 0
+        # Incremented on every change, compared by the render thread to know when to render
+        self.version = 0
+        self.finished = False
+        self.failed = False
+        # Directory of the downloaded instances, known once finished
+        self.dicomDataPath = None
+        # Series cache directory, None if the series was not published
+        self.seriesPath = None
+        self.lock = threading.Lock()
+
+        columns, rows, count = dimensions
+        self.array = np.full((count, rows, columns), fillValue, dtype=dtype)
+
+        self.imageData = vtk.vtkImageData()
+        self.imageData.SetDimensions(dimensions)
+        self.imageData.SetSpacing(spacing)
+        self.imageData.SetOrigin(origin)
+        # The vtk array shares the memory of self.array
+        self.imageData.GetPointData().SetScalars(numpy_to_vtk(self.array.reshape(-1), deep=False))
+
+    @staticmethod
+    def fromMetadata(metadatas: List[Dict]) -> Optional["ProgressiveVolume"]:
+        '''
+        Description: Allocate the volume described by the WADO-RS metadata of a series.
+        Return: None if the series is not a stack of parallel single frame slices of the same size
+        '''
+        slices = []
+        for metadata in metadatas:
+            if int(_values(metadata, "00280008", [1])[0]) != 1:
+                # Multi-frame instance
+                return None
+            position = _values(metadata, "00200032")
+            orientation = _values(metadata, "00200037")
+            rows = _values(metadata, "00280010")
+            columns = _values(metadata, "00280011")
+            if position is None or orientation is None or rows is None or columns is None:
+                return None
+            slices.append((metadata, [float(value) for value in position], [float(value) for value in orientation], int(rows[0]), int(columns[0])))
+        if not slices:
+            return None
+
+        first = slices[0]
+        orientation, rows, columns = first[2], first[3], first[4]
+        for _, _, sliceOrientation, sliceRows, sliceColumns in slices:
+            if (sliceRows, sliceColumns) != (rows, columns) or not np.allclose(sliceOrientation, orientation, atol=1e-4):
+                return None
+
+        normal = np.cross(orientation[:3], orientation[3:])
+        slices.sort(key=lambda item: float(np.dot(item[1], normal)))
+        distances = [float(np.dot(item[1], normal)) for item in slices]
+        if len(slices) > 1:
+            sliceSpacing = (distances[-1] - distances[0]) / (len(slices) - 1)
+            if sliceSpacing <= 0:
+                # Several instances at the same position
+                return None
+        else:
+            sliceSpacing = float(_values(first[0], "00180050", [1.0])[0])
+
+        pixelSpacing = [float(value) for value in _values(first[0], "00280030", [1.0, 1.0])]
+
+        # Scalar type able to hold every rescaled value, as small as possible
+        bitsStored = int(_values(first[0], "00280101", [16])[0])
+        signed = int(_values(first[0], "00280103", [0])[0]) == 1
+        storedRange = (-(1 << (bitsStored - 1)), (1 << (bitsStored - 1)) - 1) if signed else (0, (1 << bitsStored) - 1)
+        dtype = np.dtype(np.int16)
+        low, high = np.iinfo(np.int16).max, np.iinfo(np.int16).min
+        fillValue = None
+        for metadata, *_ in slices:
+            slope = float(_values(metadata, "00281053", [1.0])[0])
+            intercept = float(_values(metadata, "00281052", [0.0])[0])
+            if fillValue is None:
+                # Value of a stored zero, the background of the missing slices
+                fillValue = intercept
+            if not slope.is_integer() or not intercept.is_integer():
+                dtype = np.dtype(np.float32)
+            values = (storedRange[0] * slope + intercept, storedRange[1] * slope + intercept)
+            low, high = min(low, *values), max(high, *values)
+        if dtype != np.float32:
+            for candidate in (np.int16, np.uint16, np.int32):
+                if np.iinfo(candidate).min <= low and high <= np.iinfo(candidate).max:
+                    dtype = np.dtype(candidate)
+                    break
+            else:
+                dtype = np.dtype(np.float32)
+
+        return ProgressiveVolume(
+            objectUIDs=[metadata["00080018"]["Value"][0] for metadata, *_ in slices],
+            dimensions=[columns, rows, len(slices)],
+            spacing=[pixelSpacing[1], pixelSpacing[0], sliceSpacing],
+            origin=slices[0][1],
+            dtype=dtype,
+            fillValue=fillValue
+        )
+
+    def downloadOrder(self) -> List[str]:
+        return [self.objectUIDs[index] for index in coarseToFineOrder(len(self.objectUIDs))]
+
+    def addSlice(self, objectUID: str, path: str) -> None:
+        index = self.indexOf.get(objectUID)
+        if index is None:
+            return
+        try:
+            dataset = dcmread(path)
+            pixels = dataset.pixel_array
+            if pixels.shape != self.array.shape[1:]:
+                raise ValueError(f"unexpected slice shape {pixels.shape}")
+            slope = float(getattr(dataset, "RescaleSlope", 1.0))
+            intercept = float(getattr(dataset, "RescaleIntercept", 0.0))
+            values = pixels[::-1].astype(np.float32) * slope + intercept
+            if self.array.dtype != np.float32:
+                values = np.rint(values)
+            values = values.astype(self.array.dtype)
+        except Exception as e:
+            # The series is read again with vtkDICOMImageReader once downloaded
+            logging.error(f"{objectUID}: {e}")
+            self.failed = True
+            return
+
+        with self.lock:
+            self.array[index] = values
+            if not self.loaded[index]:
+                self.loaded[index] = True
+                self.loadedCount += 1
+            # Stand in for the missing slices above, up to the next loaded one
+            end = index + 1
+            while end < min(len(self.loaded), index + COARSE_STRIDE) and not self.loaded[end]:
+                end += 1
+            self.array[index + 1:end] = values
+            self.version += 1
+
+    def finish(self, dicomDataPath: str, seriesPath: Optional[str] = None) -> None:
+        self.dicomDataPath = dicomDataPath
+        self.seriesPath = seriesPath
+        if self.loadedCount != len(self.loaded):
+            # Instances which could not be downloaded keep standing in with their neighbour
+            logging.error(f"{len(self.loaded) - self.loadedCount}/{len(self.loaded)} slices are missing from the volume")
+        self.finished = True
+
+    def release(self) -> None:
+        # Once the volume is used from the volume cache
+        self.imageData = None
+        self.array = None
@@ -261,12 +261,14 @@ class AfterInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
                 points = pipeline.line.GetPoints()
                 # Update the position of text actor
                 buildArcAngleMeasurement(pipeline.arc, pipeline.textActor, renderer, points)
-            self.GetInteractor().Render()
         
         if len(self._length_measurement_pipelines):
             for pipeline in self._length_measurement_pipelines:
                 points = pipeline.line.GetPoints()
                 # Method used to update the position of text actor
                 buildTextActorLengthMeasurement(pipeline.textActor, renderer, points)
+
+        # One render for every measurement
+        if len(self._angle_measurement_pipelines) or len(self._length_measurement_pipelines):
             self.GetInteractor().Render()
         self.OnMouseMove()
\ No newline at end of file
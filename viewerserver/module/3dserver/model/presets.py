@@ -3,6 +3,8 @@ from model.colormap import CUSTOM_COLORMAP
 BONE_CT = {
     "transferFunction": {
         "scalarOpacityRange": [184.129411764706, 2271.070588235294],
+        # Used instead for a volume which is not in Hounsfield units: percentiles of its values
+        "percentileRange": [95, 99.9],
     },
     "colorMap": CUSTOM_COLORMAP.get("STANDARD_CT"),
 }
@@ -10,6 +12,7 @@ BONE_CT = {
 ANGIO_CT = {
     "transferFunction": {
         "scalarOpacityRange": [125.42352941176478, 1785],
+        "percentileRange": [90, 99.5],
     },
     "colorMap": CUSTOM_COLORMAP.get("STANDARD_CT"),
 }
@@ -17,13 +20,43 @@ ANGIO_CT = {
 MUSCLE_CT = {
     "transferFunction": {
         "scalarOpacityRange": [-63.16470588235279, 559.1764705882356],
+        "percentileRange": [60, 98],
     },
     "colorMap": CUSTOM_COLORMAP.get("STANDARD_CT"),
 }
 
 MIP = {
     "transferFunction": {
-        "scalarOpacityRange": [-1661.5882352941176, 2449.5490196078435]
+        "scalarOpacityRange": [-1661.5882352941176, 2449.5490196078435],
+        "percentileRange": [0.5, 99.5],
     },
     "colorMap": CUSTOM_COLORMAP.get("BLACK_TO_WHITE"),
-}
\ No newline at end of file
+    "blendMode": "mip",
+}
+
+MINIP = {
+    "transferFunction": {
+        "scalarOpacityRange": [-1661.5882352941176, 2449.5490196078435],
+        "percentileRange": [0.5, 99.5],
+    },
+    "colorMap": CUSTOM_COLORMAP.get("BLACK_TO_WHITE"),
+    "blendMode": "minip",
+}
+
+AVERAGE = {
+    "transferFunction": {
+        "scalarOpacityRange": [-1661.5882352941176, 2449.5490196078435],
+        "percentileRange": [0.5, 99.5],
+    },
+    "colorMap": CUSTOM_COLORMAP.get("BLACK_TO_WHITE"),
+    "blendMode": "average",
+}
+
+PRESETS = {
+    "bone.ct": BONE_CT,
+    "angio.ct": ANGIO_CT,
+    "muscle.ct": MUSCLE_CT,
+    "mip": MIP,
+    "minip": MINIP,
+    "average": AVERAGE,
+}
@@ -1,12 +1,9 @@
 from vtk.web import protocols as vtk_protocols
 from wslink import register as exportRpc
+from wslink import schedule_callback
 
 import vtk
 from vtkmodules.vtkCommonCore import vtkCommand
-from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-
-from model.colormap import CUSTOM_COLORMAP
-from model.presets import *
 
 from measurement.utils import AfterInteractorStyle
 from measurement.length_measurement import LengthMeasurementPipeline, LengthMeasurementInteractorStyle
@@ -14,14 +11,26 @@ from measurement.angle_measurement import AngleMeasurementPipeline, AngleMeasure
 
 from cropping.crop_freehand import Contour2DPipeline, CropFreehandInteractorStyle, Operation
 from cropping.utils import IPWCallback
+from cropping.volume_edits import VolumeEdits, Box
 
 from panning.panning_3dobject import PanningInteractorStyle
+from render.quality import InteractiveQuality
+from render.preset_engine import PresetEngine
+from render.volume_statistics import VolumeStatistics
+from render.pyramid import VolumePyramid
+from cache.volume_cache import readVolume, writeVolume
 from utils.utils import getInfoMemory
 
+import asyncio
+import functools
 import logging
+from typing import List
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+# Seconds between two renders of a volume which is still being downloaded
+PROGRESSIVE_REFRESH_INTERVAL = 0.5
+
 # -------------------------------------------------------------------------
 # ViewManager
 # -------------------------------------------------------------------------
@@ -29,21 +38,38 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(level
 class Dicom3D(vtk_protocols.vtkWebProtocol):
     def __init__(self):
         # Data
+        # Done once the series can be read, set by the server when the client connects
+        self.dataReady = None
         self._dicomDataPath = None
+        # Series cache directory holding the volume cache, None if the series is not cached
+        self.seriesPath = None
+        # Series cache and key of the series, files are added to its directory through them
+        self.seriesCache = None
+        self.seriesKey = None
+        # Volume filled while the series is downloading, None once it is complete
+        self.progressiveVolume = None
+        self.progressiveVersion = -1
     
         # Pipeline
         self.colors = vtk.vtkNamedColors()
-        self.reader = vtk.vtkDICOMImageReader()
-        # self.mask = vtk.vtkImageData()
-        self.mask = None
+        # Voxels changed by the freehand cropping, restored on reset
+        self.volumeEdits = None
         self.mapper = vtk.vtkSmartVolumeMapper()
         # self.mapper = vtk.vtkFixedPointVolumeRayCastMapper()
         self.volProperty = vtk.vtkVolumeProperty()
         self.volume = vtk.vtkVolume()
+        # Lower quality while the view is dragged
+        self.interactiveQuality = None
+        # Downsampled levels of the volume, rendered while dragging and when zoomed out
+        self.pyramid = None
+        # Boxes cropped while the pyramid is built, applied to it once built
+        self.pyramidEdits = None
         
-        # Transfer Function
-        self.color = vtk.vtkColorTransferFunction()
-        self.scalarOpacity = vtk.vtkPiecewiseFunction()
+        # Transfer Function: presets built once, applied by pointing the property to them
+        self.presetEngine = PresetEngine()
+        self.presetName = "bone.ct"
+        # Histogram of the loaded volume, the presets are fitted to it
+        self.volumeStatistics = None
 
         # Background Dark/Light
         self.checkLight = False
@@ -83,21 +109,16 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
     def dicomDataPath(self, path):
         self._dicomDataPath = path
 
-    def colorMappingWithStandardCT(self) -> None:
-        self.color.RemoveAllPoints()
-        rgbPoints = CUSTOM_COLORMAP.get("STANDARD_CT").get("rgbPoints")
-        for point in rgbPoints:
-            self.color.AddRGBPoint(point[0], point[1], point[2], point[3])
-        self.volProperty.SetColor(self.color)
-    
+    def applyPreset(self, name: str) -> bool:
+        if not self.presetEngine.apply(name, self.volProperty, self.mapper):
+            logging.warning(f"No preset {name}")
+            return False
+        self.presetName = name
+        return True
+
     def setDefaultPreset(self) -> None:
         # Bone Preset
-        self.colorMappingWithStandardCT()
-
-        self.scalarOpacity.RemoveAllPoints()
-        scalarOpacityRange = BONE_CT.get("transferFunction").get("scalarOpacityRange")
-        self.scalarOpacity.AddPoint(scalarOpacityRange[0], 0)
-        self.scalarOpacity.AddPoint(scalarOpacityRange[1], 1)
+        self.applyPreset("bone.ct")
 
     def resetBox(self) -> None:
         renderWindowInteractor = self.getApplication().GetObjectIdMap().GetActiveObject("INTERACTOR")
@@ -133,8 +154,140 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
             self.widget.Off()
             self.checkBox = False
 
+    def requestRender(self) -> None:
+        '''
+        Description: Mark the view dirty and ask the image delivery for a frame. The frame is
+            rendered by the delivery, once for every request made within a display interval.
+        '''
+        self.getApplication().InvalidateCache(self.getView('-1'))
+        self.getApplication().InvokeEvent(vtkCommand.UpdateEvent)
+
+    def readDirectory(self, path: str) -> vtk.vtkImageData:
+        # Reader, its output is used as is and released with it
+        reader = vtk.vtkDICOMImageReader()
+        reader.SetDirectoryName(path)
+        reader.Update()
+        return reader.GetOutput()
+
+    def loadVolume(self, path: str) -> vtk.vtkImageData:
+        if self.seriesPath is not None:
+            # Copy on write: only the pages changed by cropping are private to the session
+            imageData = readVolume(self.seriesPath, "c")
+            if imageData is not None:
+                logging.info("Volume mapped from the volume cache")
+                return imageData
+
+        imageData = self.readDirectory(path)
+        if self.seriesPath is not None:
+            # Other sessions of the series may write it at the same time
+            self.seriesCache.extend(self.seriesKey, lambda seriesPath: writeVolume(seriesPath, imageData))
+            # Map the file just written instead, the memory of the reader output is released
+            mappedImageData = readVolume(self.seriesPath, "c")
+            if mappedImageData is not None:
+                return mappedImageData
+        return imageData
+
+    def refreshProgressiveVolume(self) -> None:
+        '''
+        Description: Render the slices received since the last call, then call again later
+            until the download is finished. Runs on the event loop, the download threads
+            only write into the volume.
+        '''
+        volume = self.progressiveVolume
+
+        finished = volume.finished
+        if finished and volume.failed:
+            logging.warning("Some slices could not be decoded, reading the series with vtkDICOMImageReader")
+            self.dicomDataPath = volume.dicomDataPath
+            self.imageData = self.readDirectory(self.dicomDataPath)
+            self.mapper.SetInputData(self.imageData)
+        elif volume.version != self.progressiveVersion:
+            self.progressiveVersion = volume.version
+            self.imageData.GetPointData().GetScalars().Modified()
+            logging.info(f"{volume.loadedCount}/{len(volume.loaded)} slices loaded")
+        elif not finished:
+            schedule_callback(PROGRESSIVE_REFRESH_INTERVAL, self.refreshProgressiveVolume)
+            return
+
+        if finished:
+            cached = False
+            if not volume.failed and volume.seriesPath is not None:
+                # Render from the volume cache, whose pages are shared by every session of the series
+                mappedImageData = readVolume(volume.seriesPath, "c")
+                if mappedImageData is not None:
+                    self.imageData = mappedImageData
+                    self.mapper.SetInputData(self.imageData)
+                    volume.release()
+                    cached = True
+            self.progressiveVolume = None
+            self.buildPyramid(cached)
+            self.updateVolumeStatistics()
+            self.applyPreset(self.presetName)
+        else:
+            schedule_callback(PROGRESSIVE_REFRESH_INTERVAL, self.refreshProgressiveVolume)
+
+        self.requestRender()
+
+    def updateVolumeStatistics(self) -> None:
+        '''
+        Description: Compute the histogram of the volume once it is loaded and fit the built-in
+            presets to it, see render/preset_engine.py.
+        '''
+        self.volumeStatistics = VolumeStatistics.fromImageData(self.imageData)
+        self.presetEngine.setStatistics(self.volumeStatistics)
+        if not self.volumeStatistics.isHounsfield:
+            logging.info(f"Values from {self.volumeStatistics.minimum} to {self.volumeStatistics.maximum}, presets fitted to the volume")
+
+    def buildPyramid(self, cached: bool) -> None:
+        '''
+        Description: Build the levels of the loaded volume, or map them from the volume cache
+            of the series, see render/pyramid.py.
+        Params:
+            cached: the volume is the volume cache of the series
+            Built by the executor, downsampling a large volume takes seconds: the volume is
+            rendered at full resolution meanwhile, the levels are swapped in on the event loop.
+        '''
+        self.pyramid = None
+        self.interactiveQuality.setPyramid(None)
+        self.pyramidEdits = []
+        imageData = self.imageData
+        if cached and self.seriesCache is not None:
+            build = functools.partial(VolumePyramid.build, imageData, self.seriesCache, self.seriesKey)
+        else:
+            build = functools.partial(VolumePyramid.build, imageData)
+        future = asyncio.get_event_loop().run_in_executor(None, build)
+        future.add_done_callback(lambda future: self.__pyramidBuilt(imageData, future))
+
+    def __pyramidBuilt(self, imageData: vtk.vtkImageData, future: asyncio.Future) -> None:
+        if imageData is not self.imageData:
+            # Another volume was loaded meanwhile, its own pyramid is being built
+            return
+        edits, self.pyramidEdits = self.pyramidEdits, None
+        try:
+            pyramid = future.result()
+        except Exception as e:
+            logging.error(f"Volume pyramid not built: {e}")
+            return
+        if edits:
+            # The levels may have read the volume before or after these crops
+            pyramid.update(edits)
+        self.pyramid = pyramid
+        self.interactiveQuality.setPyramid(pyramid)
+        self.requestRender()
+
+    def updatePyramid(self, boxes: List[Box]) -> None:
+        # Voxels changed by the freehand cropping
+        if self.pyramid is not None:
+            self.pyramid.update(boxes)
+        elif self.pyramidEdits is not None:
+            self.pyramidEdits.extend(boxes)
+
     @exportRpc("vtk.initialize")
-    def createVisualization(self) -> None:
+    async def createVisualization(self) -> None:
+        if self.dataReady is not None:
+            # The series is downloaded by another thread, the event loop keeps serving meanwhile
+            await self.dataReady
+
         # 4121 MB
 
         renderWindow = self.getView('-1')
@@ -142,15 +295,15 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
 
         path = self.dicomDataPath if self.dicomDataPath is not None else "./viewerserver/module/3dserver/data/Ankle"
 
-        # Reader
-        self.reader.SetDirectoryName(path)
-        self.reader.Update()
-
-        # 4662 MB
-
-        # self.imageData = self.reader.GetOutput() # vtkImageData
-        self.imageData = vtk.vtkImageData()
-        self.imageData.DeepCopy(self.reader.GetOutput())
+        progressive = self.progressiveVolume is not None and self.progressiveVolume.imageData is not None
+        if progressive:
+            # Rendered right away, the slices show up while they are downloaded
+            self.imageData = self.progressiveVolume.imageData
+            schedule_callback(PROGRESSIVE_REFRESH_INTERVAL, self.refreshProgressiveVolume)
+        else:
+            # 4662 MB
+            self.imageData = self.loadVolume(path)
+            self.updateVolumeStatistics()
 
         # 5201 MB
 
@@ -170,18 +323,8 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
 
         # 5201 MB
 
-        # Color Mapping
-        self.colorMappingWithStandardCT()
-
-        # 5201 MB
-
-        # Bone CT: Opacity Mapping
-        self.scalarOpacity.RemoveAllPoints()
-        scalarOpacityRange = BONE_CT.get("transferFunction").get("scalarOpacityRange")
-        self.scalarOpacity.AddPoint(scalarOpacityRange[0], 0)
-        self.scalarOpacity.AddPoint(scalarOpacityRange[1], 1)
-
-        self.volProperty.SetScalarOpacity(self.scalarOpacity)
+        # Color and Opacity Mapping: the preset last selected, Bone CT by default
+        self.applyPreset(self.presetName)
 
         # 5201 MB
 
@@ -189,6 +332,12 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
         self.volume.SetMapper(self.mapper)
         self.volume.SetProperty(self.volProperty)
 
+        if self.interactiveQuality is None:
+            self.interactiveQuality = InteractiveQuality(self.getApplication(), renderWindow, self.mapper, self.volProperty)
+        if not progressive:
+            # Built once the download is finished otherwise
+            self.buildPyramid(self.seriesPath is not None)
+
         # 5202 MB
 
         # Render
@@ -219,65 +368,70 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
             self.boxRep.GetOutlineProperty().SetColor(1, 1, 1)
             self.checkLight = False
 
-        renderWindow.Render()
-        self.getApplication().InvokeEvent(vtkCommand.UpdateEvent)
+        self.requestRender()
         
     @exportRpc("vtk.dicom3d.presets.bone.ct")
     def showBoneCT(self) -> None:
-        renderWindow = self.getView('-1')
-        self.colorMappingWithStandardCT()
-
-        self.scalarOpacity.RemoveAllPoints()
-        scalarOpacityRange = BONE_CT.get("transferFunction").get("scalarOpacityRange")
-        self.scalarOpacity.AddPoint(scalarOpacityRange[0], 0)
-        self.scalarOpacity.AddPoint(scalarOpacityRange[1], 1)
-
-        renderWindow.Render()
-        self.getApplication().InvokeEvent(vtkCommand.UpdateEvent)
+        self.applyPreset("bone.ct")
+        self.requestRender()
       
     @exportRpc("vtk.dicom3d.presets.angio.ct")
     def showAngioCT(self) -> None:
-        renderWindow = self.getView('-1')
-        self.colorMappingWithStandardCT()
-
-        self.scalarOpacity.RemoveAllPoints()
-        scalarOpacityRange = ANGIO_CT.get("transferFunction").get("scalarOpacityRange")
-        self.scalarOpacity.AddPoint(scalarOpacityRange[0], 0)
-        self.scalarOpacity.AddPoint(scalarOpacityRange[1], 1)
-
-        renderWindow.Render()
-        self.getApplication().InvokeEvent(vtkCommand.UpdateEvent)
+        self.applyPreset("angio.ct")
+        self.requestRender()
 
     @exportRpc("vtk.dicom3d.presets.muscle.ct")
     def showMuscleCT(self) -> None:
-        renderWindow = self.getView('-1')
-        self.colorMappingWithStandardCT()
-
-        self.scalarOpacity.RemoveAllPoints()
-        scalarOpacityRange = MUSCLE_CT.get("transferFunction").get("scalarOpacityRange")
-        self.scalarOpacity.AddPoint(scalarOpacityRange[0], 0)
-        self.scalarOpacity.AddPoint(scalarOpacityRange[1], 1)
-
-        renderWindow.Render()
-        self.getApplication().InvokeEvent(vtkCommand.UpdateEvent)
+        self.applyPreset("muscle.ct")
+        self.requestRender()
 
     @exportRpc("vtk.dicom3d.presets.mip")
     def showMip(self) -> None:
-        renderWindow = self.getView('-1')
-
-        self.color.RemoveAllPoints()
-        rgbPoints = MIP.get("colorMap").get("rgbPoints")
-        if len(rgbPoints):
-            for point in rgbPoints:
-                self.color.AddRGBPoint(point[0], point[1], point[2], point[3])
-
-        self.scalarOpacity.RemoveAllPoints()
-        scalarOpacityRange = MIP.get("transferFunction").get("scalarOpacityRange")
-        self.scalarOpacity.AddPoint(scalarOpacityRange[0], 0)
-        self.scalarOpacity.AddPoint(scalarOpacityRange[1], 1)
-
-        renderWindow.Render()
-        self.getApplication().InvokeEvent(vtkCommand.UpdateEvent)
+        self.applyPreset("mip")
+        self.requestRender()
+
+    @exportRpc("vtk.dicom3d.presets.minip")
+    def showMinIP(self) -> None:
+        self.applyPreset("minip")
+        self.requestRender()
+
+    @exportRpc("vtk.dicom3d.presets.average")
+    def showAverage(self) -> None:
+        self.applyPreset("average")
+        self.requestRender()
+
+    @exportRpc("vtk.dicom3d.presets.list")
+    def listPresets(self) -> dict:
+        return {"presets": self.presetEngine.names(), "current": self.presetName}
+
+    @exportRpc("vtk.dicom3d.histogram")
+    def getHistogram(self) -> dict:
+        if self.volumeStatistics is None:
+            return {"error": "The series is not loaded yet"}
+        return {**self.volumeStatistics.toDict(), "presetRanges": self.presetEngine.opacityRanges()}
+
+    @exportRpc("vtk.dicom3d.presets.apply")
+    def applyPresetHandle(self, name: str) -> dict:
+        if not self.applyPreset(name):
+            return {"error": f"No preset {name}"}
+        self.requestRender()
+        return {"preset": name}
+
+    @exportRpc("vtk.dicom3d.presets.add")
+    def addPresetHandle(self, name: str, preset: dict, apply: bool = True) -> dict:
+        '''
+        Description: Add a user defined preset, see render/preset_engine.py for its definition.
+        '''
+        try:
+            self.presetEngine.add(name, preset)
+        except ValueError as e:
+            logging.warning(str(e))
+            return {"error": str(e)}
+        if apply or name == self.presetName:
+            # A preset replaced while in use is applied again
+            self.applyPreset(name)
+            self.requestRender()
+        return {"preset": name}
 
     def initObjectsMeasurementTool(self, renderWindowInteractor: vtk.vtkRenderWindowInteractor) -> None:
         if self.afterInteractorStyle is None:
@@ -335,7 +489,6 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
     def crop3d(self) -> None:
         # self.getApplication() -> vtkWebApplication()
         renderWindowInteractor = self.getApplication().GetObjectIdMap().GetActiveObject("INTERACTOR")
-        renderWindow = self.getView('-1')
 
         if self.boxRep is None:
             self.boxRep = vtk.vtkBoxRepresentation()
@@ -363,8 +516,7 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
             self.widget.Off()
             self.checkBox = False
 
-        renderWindow.Render()
-        self.getApplication().InvokeEvent(vtkCommand.UpdateEvent)
+        self.requestRender()
 
     @exportRpc("vtk.dicom3d.crop.freehand")
     def cropFreehandHandle(self, operation: Operation = Operation.INSIDE, fillValue: int = -1000) -> None:
@@ -373,20 +525,21 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
         renderWindowInteractor = self.getApplication().GetObjectIdMap().GetActiveObject("INTERACTOR")
         renderer = self.getView('-1').GetRenderers().GetFirstRenderer()
 
+        if self.progressiveVolume is not None:
+            # Slices still arriving would overwrite the cropped voxels
+            logging.warning("Cropping freehand is not available until the series is downloaded")
+            return
+
         if self.contour2Dpipeline is None:
             self.contour2Dpipeline = Contour2DPipeline()
 
         # 5788 MB
 
-        if self.mask is None:
-            self.mask = vtk.vtkImageData()
-            self.mask.SetExtent(self.imageData.GetExtent())
-            self.mask.SetOrigin(self.imageData.GetOrigin())
-            self.mask.SetSpacing(self.imageData.GetSpacing())
-            self.mask.SetDirectionMatrix(self.imageData.GetDirectionMatrix())
-            # self.mask.AllocateScalars(self.imageData.GetScalarType(), 1)
-            self.mask.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
-            self.mask.GetPointData().GetScalars().Fill(0)
+        if self.volumeEdits is None:
+            # The read-only volume cache lets the history drop old edits and still reset
+            pristine = readVolume(self.seriesPath, "r") if self.seriesPath is not None else None
+            self.volumeEdits = VolumeEdits(self.imageData, pristine=pristine)
+            self.volumeEdits.addObserver(self.updatePyramid)
 
         # 6058 MB
 
@@ -399,7 +552,7 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
             self.cropFreehandInteractorStyle = CropFreehandInteractorStyle(
                 contour2Dpipeline=self.contour2Dpipeline,
                 imageData=self.imageData,
-                mask=self.mask,
+                volumeEdits=self.volumeEdits,
                 operation=Operation.INSIDE,
                 fillValue=-1000,
                 afterInteractorStyle=self.afterInteractorStyle
@@ -418,22 +571,26 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
 
         # 6058 MB
 
+    @exportRpc("vtk.dicom3d.crop.undo")
+    def undoCropHandle(self) -> None:
+        if self.volumeEdits is None or not self.volumeEdits.undo():
+            return
+        self.requestRender()
+
+    @exportRpc("vtk.dicom3d.crop.redo")
+    def redoCropHandle(self) -> None:
+        if self.volumeEdits is None or not self.volumeEdits.redo():
+            return
+        self.requestRender()
+
     @exportRpc("vtk.camera.reset")
     def resetHandle(self) -> None:
         renderWindowInteractor = self.getApplication().GetObjectIdMap().GetActiveObject("INTERACTOR")
         renderWindow = self.getView('-1')
         renderer = renderWindow.GetRenderers().GetFirstRenderer()
 
-        if not self.mask is None:
-            shape = tuple(reversed(self.reader.GetOutput().GetDimensions())) # (z, y, x)
-            oriImageDataArray = vtk_to_numpy(self.reader.GetOutput().GetPointData().GetScalars()).reshape(shape)
-            maskArray = vtk_to_numpy(self.mask.GetPointData().GetScalars()).reshape(shape)
-            imageDataArray = vtk_to_numpy(self.imageData.GetPointData().GetScalars()).reshape(shape)
-
-            imageDataArray[maskArray > 0] = oriImageDataArray[maskArray > 0]
-
-            self.imageData.GetPointData().SetScalars(numpy_to_vtk(imageDataArray.reshape(1, -1)[0]))
-            self.mask.GetPointData().GetScalars().Fill(0)
+        if not self.volumeEdits is None:
+            self.volumeEdits.restoreAll()
 
         # Set origin 3D object
         # self.mapper.SetInputData(self.imageData)
@@ -448,9 +605,6 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
         renderer.RemoveAllViewProps()
         renderer.AddVolume(self.volume)
 
-        # Render window
-        renderWindow.Render()
-
         # Turn off panning interactor
         self.checkPanning = False
 
@@ -458,8 +612,7 @@ class Dicom3D(vtk_protocols.vtkWebProtocol):
         style = vtk.vtkInteractorStyleTrackballCamera()
         renderWindowInteractor.SetInteractorStyle(style)
         
-        self.getApplication().InvalidateCache(renderWindow)
-        self.getApplication().InvokeEvent(vtkCommand.UpdateEvent)
+        self.requestRender()
     
     @exportRpc("vtk.dicom3d.panning")
     def panning(self) -> None:
@@ -0,0 +1,196 @@
+from vtk.web import protocols as vtk_protocols
+from wslink import register as exportRpc
+from wslink import schedule_callback
+
+import vtk
+
+import base64
+import hashlib
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from render.stream import StreamController, FRAME_TIMEOUT
+
+# JPEG quality of the frames rendered while the view is dragged
+INTERACTIVE_QUALITY = 50
+# Seconds over which the current bandwidth is measured
+STATS_WINDOW = 5.0
+
+# Image compression of vtkWebApplication for each image format
+COMPRESSION = {
+    "jpeg": vtk.vtkWebApplication.COMPRESSION_JPEG,
+    "png": vtk.vtkWebApplication.COMPRESSION_PNG
+}
+
+'''
+Description: Frames and bytes sent to the client of the session.
+'''
+class DeliveryStats():
+    def __init__(self, window: float = STATS_WINDOW) -> None:
+        self.window = window
+        self.frames = 0
+        self.skipped = 0
+        self.bytes = 0
+        # Time of the first frame, the rates are over the time elapsed since until the window is full
+        self.firstTime: Optional[float] = None
+        # (time, size) of the frames sent within the window
+        self.recent: Deque[Tuple[float, int]] = deque()
+
+    def add(self, size: int) -> None:
+        self.frames += 1
+        self.bytes += size
+        now = time.time()
+        if self.firstTime is None:
+            self.firstTime = now
+        self.recent.append((now, size))
+
+    def toDict(self) -> Dict:
+        now = time.time()
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+        elapsed = min(self.window, now - self.firstTime) if self.firstTime is not None else self.window
+        # At least a frame interval, a single frame is not an infinite rate
+        elapsed = max(elapsed, 1.0 / 60)
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "bytes": self.bytes,
+            "averageFrameBytes": self.bytes // self.frames if self.frames else 0,
+            "framesPerSecond": len(self.recent) / elapsed,
+            "bytesPerSecond": sum(size for _, size in self.recent) / elapsed
+        }
+
+'''
+Description: Image delivery choosing the encoding of every frame from the interaction state.
+    While the view is dragged frames are JPEG, at a quality of at most interactiveQuality.
+    Still frames use stillFormat: JPEG at the quality set by the client, or lossless PNG.
+    A frame identical to the last one sent for the view is not sent again: the view is
+    invalidated on every render request, so an unchanged view is rendered and encoded again.
+    Frames and bytes sent are counted, viewport.image.push.stats returns them.
+    The stream controller lowers the resolution, the quality and the frame rate for a client
+    which acknowledges frames late, and holds frames while too many are not acknowledged.
+    The frame rate is the lowest of the one set by the client and the one of the controller.
+'''
+class ImageDelivery(vtk_protocols.vtkWebPublishImageDelivery):
+    def __init__(
+            self,
+            decode: bool = True,
+            interactiveQuality: int = INTERACTIVE_QUALITY,
+            stillFormat: str = "jpeg",
+            streamController: Optional[StreamController] = None
+        ) -> None:
+        super().__init__(decode=decode)
+        self.interactiveQuality = interactiveQuality
+        self.stillFormat = stillFormat
+        self.streamController = streamController if streamController is not None else StreamController()
+        # Set through viewport.image.animation.fps.max, maxFrameRate is lowered by the controller
+        self.clientMaxFrameRate = self.maxFrameRate
+        # Views with a frame held until the client acknowledges one
+        self.waitingViews: Set[str] = set()
+        # Digest of the last frame sent for each view
+        self.lastDigest: Dict[str, bytes] = {}
+        self.stats = DeliveryStats()
+
+    def pushRender(self, vId, ignoreAnimation=False):
+        # Same as vtkWebPublishImageDelivery.pushRender, with the encoding and the unchanged frames
+        if vId not in self.trackingViews:
+            return
+        tracking = self.trackingViews[vId]
+        if not tracking["enabled"]:
+            return
+
+        interacting = len(self.viewsInAnimations) > 0
+        if not ignoreAnimation and interacting:
+            return
+
+        if not self.streamController.canSend():
+            if vId not in self.waitingViews:
+                self.waitingViews.add(vId)
+                # Sent anyway once the frames in flight are considered lost
+                schedule_callback(FRAME_TIMEOUT, self.__pushWaitingViews)
+            return
+        self.maxFrameRate = min(self.clientMaxFrameRate, self.streamController.frameRate())
+
+        if "originalSize" not in tracking:
+            tracking["originalSize"] = list(self.getView(vId).GetSize())
+        if "ratio" not in tracking:
+            tracking["ratio"] = 1
+        scale = tracking["ratio"] * self.streamController.resolutionScale
+        size = [int(s * scale) for s in tracking["originalSize"]]
+
+        if interacting:
+            imageFormat, quality = "jpeg", min(tracking["quality"], self.interactiveQuality)
+        else:
+            imageFormat, quality = self.stillFormat, tracking["quality"]
+        quality = min(quality, self.streamController.qualityCap)
+        self.getApplication().SetImageCompression(COMPRESSION[imageFormat])
+
+        reply = self.stillRender({"view": vId, "mtime": tracking["mtime"], "quality": quality, "size": size})
+        stale = reply["stale"]
+        if reply["image"]:
+            if self.decode:
+                reply["image"] = base64.standard_b64decode(reply["image"])
+            tracking["mtime"] = reply["mtime"]
+
+            digest = hashlib.blake2b(reply["image"], digest_size=16).digest()
+            if digest == self.lastDigest.get(vId):
+                self.stats.skipped += 1
+            else:
+                self.lastDigest[vId] = digest
+                self.stats.add(len(reply["image"]))
+                reply["image"] = self.addAttachment(reply["image"])
+                reply["format"] = imageFormat
+                # echo back real ID, instead of -1 for 'active'
+                reply["id"] = vId
+                # Sent back by the client through viewport.image.push.ack
+                reply["frame"] = self.streamController.frameSent()
+                self.publish("viewport.image.push.subscription", reply)
+
+        if stale:
+            self.lastStaleTime = time.time()
+            if self.staleHandlerCount == 0:
+                self.staleHandlerCount += 1
+                schedule_callback(self.deltaStaleTimeBeforeRender, lambda: self.renderStaleImage(vId))
+        else:
+            self.lastStaleTime = 0
+
+    @exportRpc("viewport.image.push")
+    def imagePush(self, options):
+        # The client asks for a frame, even if it is the last one sent
+        self.lastDigest.pop(str(self.getGlobalId(self.getView(options["view"]))), None)
+        super().imagePush(options)
+
+    @exportRpc("viewport.image.push.observer.add")
+    def addRenderObserver(self, viewId):
+        sView = self.getView(viewId)
+        if sView:
+            # A new subscriber has no frame yet
+            self.lastDigest.pop(str(self.getGlobalId(sView)), None)
+        return super().addRenderObserver(viewId)
+
+    @exportRpc("viewport.image.animation.fps.max")
+    def setMaxFrameRate(self, fps=30):
+        self.clientMaxFrameRate = fps
+        self.maxFrameRate = min(fps, self.streamController.frameRate())
+
+    def __pushWaitingViews(self) -> None:
+        waitingViews = list(self.waitingViews)
+        self.waitingViews.clear()
+        for vId in waitingViews:
+            self.pushRender(vId)
+
+    @exportRpc("viewport.image.push.ack")
+    def ackFrame(self, frame: int) -> None:
+        self.streamController.ack(frame)
+        self.__pushWaitingViews()
+
+    @exportRpc("viewport.image.push.stats")
+    def getStats(self) -> Dict:
+        stats = self.stats.toDict()
+        stats["interactiveQuality"] = self.interactiveQuality
+        stats["stillFormat"] = self.stillFormat
+        stats["streamLevel"] = self.streamController.level
+        stats["latency"] = self.streamController.latency
+        stats["maxFrameRate"] = self.maxFrameRate
+        return stats
@@ -0,0 +1,156 @@
+import vtk
+
+import math
+from typing import Dict, List, Optional
+
+from model.presets import PRESETS
+from render.volume_statistics import VolumeStatistics
+
+# Blend mode of the volume mapper for each blend mode name of a preset
+BLEND_MODES = {
+    "composite": vtk.vtkVolumeMapper.COMPOSITE_BLEND,
+    "mip": vtk.vtkVolumeMapper.MAXIMUM_INTENSITY_BLEND,
+    "minip": vtk.vtkVolumeMapper.MINIMUM_INTENSITY_BLEND,
+    "average": vtk.vtkVolumeMapper.AVERAGE_INTENSITY_BLEND
+}
+# Presets a client may add, and points of their transfer functions
+MAX_USER_PRESETS = 32
+MAX_PRESET_POINTS = 256
+
+'''
+Description: Transfer functions and blend mode of a preset, built once.
+'''
+class Preset():
+    __slots__ = ["name", "color", "scalarOpacity", "blendMode"]
+    def __init__(self, name: str, color: vtk.vtkColorTransferFunction, scalarOpacity: vtk.vtkPiecewiseFunction, blendMode: int) -> None:
+        self.name = name
+        self.color = color
+        self.scalarOpacity = scalarOpacity
+        self.blendMode = blendMode
+
+'''
+Description: Build a preset from its definition, as in model/presets.py:
+    {
+        "transferFunction": {"scalarOpacityRange": [low, high]}
+                         or {"scalarOpacityPoints": [[value, opacity], ...]},
+        "colorMap": {"rgbPoints": [[value, r, g, b], ...]},   <--- optional
+        "blendMode": "composite" | "mip" | "minip" | "average"  <--- optional, composite
+    }
+    Without color points the colors are a grayscale ramp over the opacity range.
+Return: the preset, ValueError if the definition is not valid
+'''
+def buildPreset(name: str, definition: Dict) -> Preset:
+    try:
+        if not isinstance(definition, dict):
+            raise TypeError("the preset is an object")
+        transferFunction = definition["transferFunction"]
+        colorMap = definition.get("colorMap") or {}
+        if not isinstance(transferFunction, dict) or not isinstance(colorMap, dict):
+            raise TypeError("transferFunction and colorMap are objects")
+        if "scalarOpacityPoints" in transferFunction:
+            opacityPoints = [(float(value), float(opacity)) for value, opacity in transferFunction["scalarOpacityPoints"]]
+        else:
+            low, high = (float(value) for value in transferFunction["scalarOpacityRange"])
+            opacityPoints = [(low, 0.0), (high, 1.0)]
+        rgbPoints = [[float(value) for value in point] for point in colorMap.get("rgbPoints", [])]
+        blendModeName = definition.get("blendMode", "composite")
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid preset {name}: {e}")
+
+    if not opacityPoints or len(opacityPoints) + len(rgbPoints) > MAX_PRESET_POINTS:
+        raise ValueError(f"Invalid preset {name}: between 1 and {MAX_PRESET_POINTS} points expected")
+    if any(len(point) != 4 for point in rgbPoints):
+        raise ValueError(f"Invalid preset {name}: color points are [value, r, g, b]")
+    values = [value for point in opacityPoints for value in point] + [value for point in rgbPoints for value in point]
+    if not all(math.isfinite(value) for value in values):
+        raise ValueError(f"Invalid preset {name}: values must be finite numbers")
+    if blendModeName not in BLEND_MODES:
+        raise ValueError(f"Invalid preset {name}: blend mode is one of {', '.join(BLEND_MODES)}")
+
+    scalarOpacity = vtk.vtkPiecewiseFunction()
+    for value, opacity in opacityPoints:
+        scalarOpacity.AddPoint(value, opacity)
+
+    color = vtk.vtkColorTransferFunction()
+    if not rgbPoints:
+        low, high = min(value for value, _ in opacityPoints), max(value for value, _ in opacityPoints)
+        rgbPoints = [[low, 0.0, 0.0, 0.0], [high, 1.0, 1.0, 1.0]]
+    for value, r, g, b in rgbPoints:
+        color.AddRGBPoint(value, r, g, b)
+
+    return Preset(name, color, scalarOpacity, BLEND_MODES[blendModeName])
+
+'''
+Description: Fit a built-in preset to a volume which is not in Hounsfield units: its opacity
+    range becomes the percentiles of the volume given by "percentileRange", and its color
+    points are moved along with it.
+Return: the definition to build, unchanged for a CT volume
+'''
+def adaptDefinition(definition: Dict, statistics: Optional[VolumeStatistics]) -> Dict:
+    transferFunction = definition["transferFunction"]
+    if statistics is None or statistics.isHounsfield or "percentileRange" not in transferFunction:
+        return definition
+    low, high = transferFunction["scalarOpacityRange"]
+    newLow, newHigh = (statistics.percentile(percent) for percent in transferFunction["percentileRange"])
+    if newHigh <= newLow:
+        # Constant volume
+        return definition
+
+    scale = (newHigh - newLow) / (high - low)
+    rgbPoints = (definition.get("colorMap") or {}).get("rgbPoints", [])
+    return {
+        **definition,
+        "transferFunction": {"scalarOpacityRange": [newLow, newHigh]},
+        "colorMap": {"rgbPoints": [[newLow + (point[0] - low) * scale] + list(point[1:]) for point in rgbPoints]}
+    }
+
+'''
+Description: Presets of the session, each built once: applying one only points the volume
+    property to its transfer functions and sets the blend mode of the mapper, so the switch
+    happens between two renders without rebuilding anything.
+    The presets of model/presets.py are built when the engine is created, and again once the
+    statistics of the volume are known, the ones added by the client when they are added.
+'''
+class PresetEngine():
+    def __init__(self, statistics: Optional[VolumeStatistics] = None) -> None:
+        self.presets: Dict[str, Preset] = {}
+        self.userPresets: List[str] = []
+        self.setStatistics(statistics)
+
+    def setStatistics(self, statistics: Optional[VolumeStatistics]) -> None:
+        self.statistics = statistics
+        for name, definition in PRESETS.items():
+            self.presets[name] = buildPreset(name, adaptDefinition(definition, statistics))
+
+    def names(self) -> List[str]:
+        return list(self.presets)
+
+    def opacityRanges(self) -> Dict[str, List[float]]:
+        return {name: list(preset.scalarOpacity.GetRange()) for name, preset in self.presets.items()}
+
+    def add(self, name: str, definition: Dict) -> Preset:
+        '''
+        Description: Add or replace a user defined preset. Built-in presets can not be replaced.
+        Return: the preset, ValueError if it can not be added
+        '''
+        if name in PRESETS:
+            raise ValueError(f"Preset {name} is a built-in preset")
+        if name not in self.userPresets and len(self.userPresets) >= MAX_USER_PRESETS:
+            raise ValueError(f"At most {MAX_USER_PRESETS} user presets")
+        preset = buildPreset(name, definition)
+        self.presets[name] = preset
+        if name not in self.userPresets:
+            self.userPresets.append(name)
+        return preset
+
+    def apply(self, name: str, volProperty: vtk.vtkVolumeProperty, mapper: vtk.vtkVolumeMapper) -> bool:
+        '''
+        Return: False if there is no preset with this name
+        '''
+        preset = self.presets.get(name)
+        if preset is None:
+            return False
+        volProperty.SetColor(preset.color)
+        volProperty.SetScalarOpacity(preset.scalarOpacity)
+        mapper.SetBlendMode(preset.blendMode)
+        return True
@@ -0,0 +1,149 @@
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+import numpy as np
+
+import math
+import logging
+from typing import Dict, List, Optional
+
+from cache.series_cache import SeriesCache
+from cache.volume_cache import imageDataFromArray, readVolume, writeVolume
+from cropping.volume_edits import Box
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Downsampling factors of the levels built below the volume as loaded, each level is computed
+# from the previous one so a factor is a multiple of the previous factor
+PYRAMID_LEVELS = [2, 4]
+# A level is only built if it keeps at least this many voxels along every axis
+MIN_LEVEL_DIMENSION = 16
+# Slices of a level computed at a time, bounds the memory of the float sums
+CHUNK_SLICES = 32
+
+def _arrayOf(imageData: vtk.vtkImageData) -> np.ndarray:
+    shape = tuple(reversed(imageData.GetDimensions())) # (z, y, x)
+    return vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
+
+'''
+Description: Average the blocks of factor^3 voxels of a (z, y, x) array, the last block
+    along an axis may be smaller.
+'''
+def blockMean(array: np.ndarray, factor: int) -> np.ndarray:
+    result = array
+    for axis in range(3):
+        starts = np.arange(0, array.shape[axis], factor)
+        counts = np.diff(np.append(starts, array.shape[axis])).astype(np.float32)
+        # Summed as float32 from the first axis on, the input is never copied as a whole
+        result = np.add.reduceat(result, starts, axis=axis, dtype=np.float32)
+        result /= counts.reshape([-1 if i == axis else 1 for i in range(3)])
+    if np.issubdtype(array.dtype, np.integer):
+        np.rint(result, out=result)
+    return result.astype(array.dtype)
+
+'''
+Description: Volume downsampled by factor along every axis, each voxel the average of a block
+    of factor^3 voxels. The voxels are centered on their block, so the level covers the
+    same region of space as the volume.
+'''
+def downsample(imageData: vtk.vtkImageData, factor: int) -> vtk.vtkImageData:
+    array = _arrayOf(imageData)
+    level = np.empty(tuple(math.ceil(n / factor) for n in array.shape), dtype=array.dtype)
+    for z in range(0, level.shape[0], CHUNK_SLICES):
+        level[z:z + CHUNK_SLICES] = blockMean(array[z * factor:(z + CHUNK_SLICES) * factor], factor)
+
+    spacing = imageData.GetSpacing()
+    directionMatrix = imageData.GetDirectionMatrix()
+    direction = [directionMatrix.GetElement(row, col) for row in range(3) for col in range(3)]
+    shift = [(factor - 1) / 2 * s for s in spacing]
+    origin = [
+        imageData.GetOrigin()[row] + sum(direction[3 * row + col] * shift[col] for col in range(3))
+        for row in range(3)
+    ]
+    return imageDataFromArray(level, [s * factor for s in spacing], origin, direction)
+
+'''
+Description: Levels of a volume downsampled by 2 and 4, to ray cast large series at
+    interactive rates. The levels are computed once, and saved with the volume cache
+    when the series has one, under the lock of the series, so the next sessions of the
+    series map them. Each level is computed from the previous one, the 4x level reads 8 times
+    fewer voxels than from the volume.
+    Building takes seconds for a large volume and touches no VTK pipeline, it is meant to run
+    off the event loop.
+    Edits of the volume are applied to the levels by update, only on the blocks of the
+    changed boxes.
+'''
+class VolumePyramid():
+    def __init__(self, imageData: vtk.vtkImageData, levels: Dict[int, vtk.vtkImageData]) -> None:
+        self.imageData = imageData
+        # Level of each downsampling factor, 1 is the volume itself
+        self.levels: Dict[int, vtk.vtkImageData] = {1: imageData, **levels}
+        self.spacing = min(imageData.GetSpacing())
+
+    @staticmethod
+    def build(
+            imageData: vtk.vtkImageData,
+            seriesCache: Optional[SeriesCache] = None,
+            key: Optional[str] = None
+        ) -> "VolumePyramid":
+        '''
+        Params:
+            seriesCache, key: series whose volume cache holds imageData, None if not cached
+        '''
+        seriesPath = seriesCache.path(key) if seriesCache is not None else None
+        levels = {}
+        source, sourceFactor = imageData, 1
+        for factor in PYRAMID_LEVELS:
+            if min(imageData.GetDimensions()) / factor < MIN_LEVEL_DIMENSION:
+                break
+            level = readVolume(seriesPath, "c", factor) if seriesPath is not None else None
+            if level is None:
+                level = downsample(source, factor // sourceFactor)
+                # Other sessions of the series may write it at the same time
+                if seriesPath is not None and seriesCache.extend(key, lambda path: writeVolume(path, level, factor)):
+                    # Pages shared with the other sessions of the series
+                    mappedLevel = readVolume(seriesPath, "c", factor)
+                    if mappedLevel is not None:
+                        level = mappedLevel
+            levels[factor] = level
+            source, sourceFactor = level, factor
+        logging.info(f"Volume pyramid of {imageData.GetDimensions()}: levels {[1] + list(levels)}")
+        return VolumePyramid(imageData, levels)
+
+    def pixelSize(self, renderer: vtk.vtkRenderer) -> float:
+        '''
+        Return: size of a pixel of the renderer at the focal point, in world units
+        '''
+        camera = renderer.GetActiveCamera()
+        if camera.GetParallelProjection():
+            viewHeight = 2 * camera.GetParallelScale()
+        else:
+            viewHeight = 2 * camera.GetDistance() * math.tan(math.radians(camera.GetViewAngle()) / 2)
+        return viewHeight / max(1, renderer.GetSize()[1])
+
+    def level(self, renderer: vtk.vtkRenderer, minimumFactor: int = 1) -> vtk.vtkImageData:
+        '''
+        Description: Coarsest level whose voxels are not larger than a pixel of the renderer,
+            or downsampled by minimumFactor when that is coarser.
+        '''
+        factor = max(minimumFactor, self.pixelSize(renderer) / self.spacing)
+        return self.levels[max(level for level in self.levels if level <= factor)]
+
+    def update(self, boxes: List[Box]) -> None:
+        '''
+        Description: Compute again the voxels of the levels covering the changed boxes of the volume.
+        '''
+        factors = sorted(self.levels)
+        # From the finest level to the coarsest, each one from the previous one as built
+        for sourceFactor, factor in zip(factors, factors[1:]):
+            array = _arrayOf(self.levels[sourceFactor])
+            level = self.levels[factor]
+            levelArray = _arrayOf(level)
+            relative = factor // sourceFactor
+            for box in boxes:
+                z0, y0, x0 = (bound // factor for bound in box[0::2])
+                z1, y1, x1 = (math.ceil(bound / factor) for bound in box[1::2])
+                levelArray[z0:z1, y0:y1, x0:x1] = blockMean(
+                    array[z0 * relative:z1 * relative, y0 * relative:y1 * relative, x0 * relative:x1 * relative], relative
+                )
+            level.GetPointData().GetScalars().Modified()
@@ -0,0 +1,120 @@
+import vtk
+from vtkmodules.vtkCommonCore import vtkCommand
+from wslink import schedule_callback
+
+from typing import List, Optional
+
+from render.pyramid import VolumePyramid
+
+# Frame time aimed at while the view is dragged, in seconds
+TARGET_FRAME_TIME = 1.0 / 15
+# Largest downsampling factor of the volume rendered while the view is dragged
+MAX_SHRINK_FACTOR = 4
+
+'''
+Description: Lower the rendering quality of the volume while the view is dragged and render
+    at full quality on release, so that rotating stays fluid on CPU-only render nodes.
+    During a drag:
+        - the desired update rate of the render window is 1 / targetFrameTime, the smart volume
+          mapper then lowers its sample distances and image reduction factor to meet it
+        - the interpolation is nearest neighbour and the shading is off
+        - the level of the volume pyramid downsampled by shrinkFactor is rendered instead, in
+          every render mode: the GPU mode also runs on CPU-only nodes, through Mesa EGL, and
+          the levels are precomputed, so switching costs a texture upload. The factor is
+          chosen from the frame times of the previous drag: doubled when they were above the
+          target, halved when they were well below it.
+    Every frame, still or not, renders the coarsest level whose voxels are not larger than a
+    pixel of the view, see render/pyramid.py. Without a pyramid the mapper input is left as is.
+    Drags are the StartInteractionEvent/EndInteractionEvent of the web application.
+'''
+class InteractiveQuality():
+    def __init__(
+            self,
+            application,
+            renderWindow: vtk.vtkRenderWindow,
+            mapper: vtk.vtkSmartVolumeMapper,
+            volProperty: vtk.vtkVolumeProperty,
+            targetFrameTime: float = TARGET_FRAME_TIME
+        ) -> None:
+        self.application = application
+        self.renderWindow = renderWindow
+        self.mapper = mapper
+        self.volProperty = volProperty
+        self.targetFrameTime = targetFrameTime
+        self.shrinkFactor = 1
+        self.interacting = False
+        # Settings of the volume property restored on release
+        self.interpolationType = None
+        self.shade = None
+        # Levels of the volume, set once it is loaded
+        self.pyramid: Optional[VolumePyramid] = None
+        # Render times of the current drag
+        self.frameTimes: List[float] = []
+
+        self.mapper.AutoAdjustSampleDistancesOn()
+        self.mapper.InteractiveAdjustSampleDistancesOn()
+        self.mapper.SetInteractiveUpdateRate(1.0 / targetFrameTime)
+        interactor = self.renderWindow.GetInteractor()
+        if interactor is not None:
+            # Set on the render window by the interactor styles when a camera motion starts
+            interactor.SetDesiredUpdateRate(1.0 / targetFrameTime)
+
+        renderer = self.renderWindow.GetRenderers().GetFirstRenderer()
+        renderer.AddObserver(vtkCommand.StartEvent, self.__renderStart)
+        renderer.AddObserver(vtkCommand.EndEvent, self.__renderEnd)
+        self.application.AddObserver("StartInteractionEvent", self.__interactionStart)
+        self.application.AddObserver("EndInteractionEvent", self.__interactionEnd)
+
+    def setPyramid(self, pyramid: Optional[VolumePyramid]) -> None:
+        self.pyramid = pyramid
+
+    def __renderStart(self, obj: vtk.vtkRenderer, event: str) -> None:
+        if self.pyramid is None:
+            return
+        shrinkFactor = self.shrinkFactor if self.interacting else 1
+        # Chosen before the volume is rendered: the view size and the camera of this frame are set
+        level = self.pyramid.level(obj, shrinkFactor)
+        if self.mapper.GetInput() is not level:
+            self.mapper.SetInputData(level)
+
+    def __renderEnd(self, obj: vtk.vtkRenderer, event: str) -> None:
+        if self.interacting:
+            self.frameTimes.append(obj.GetLastRenderTimeInSeconds())
+
+    def __interactionStart(self, obj, event: str) -> None:
+        if self.interacting:
+            return
+        self.interacting = True
+        self.frameTimes = []
+
+        self.renderWindow.SetDesiredUpdateRate(1.0 / self.targetFrameTime)
+        self.interpolationType = self.volProperty.GetInterpolationType()
+        self.shade = self.volProperty.GetShade()
+        self.volProperty.SetInterpolationTypeToNearest()
+        self.volProperty.ShadeOff()
+
+    def __interactionEnd(self, obj, event: str) -> None:
+        if not self.interacting:
+            return
+        self.interacting = False
+
+        interactor = self.renderWindow.GetInteractor()
+        self.renderWindow.SetDesiredUpdateRate(interactor.GetStillUpdateRate() if interactor is not None else 0.0001)
+        self.volProperty.SetInterpolationType(self.interpolationType)
+        self.volProperty.SetShade(self.shade)
+
+        self.__adjustShrinkFactor()
+
+        # The last frame of the drag was rendered at low quality
+        self.application.InvalidateCache(self.renderWindow)
+        # After the image delivery stopped its interaction animation, which observes this event too
+        schedule_callback(0, lambda: self.application.InvokeEvent(vtkCommand.UpdateEvent))
+
+    def __adjustShrinkFactor(self) -> None:
+        if not self.frameTimes:
+            return
+        frameTime = sorted(self.frameTimes)[len(self.frameTimes) // 2]
+        if frameTime > self.targetFrameTime * 1.5 and self.shrinkFactor < MAX_SHRINK_FACTOR:
+            self.shrinkFactor *= 2
+        elif frameTime < self.targetFrameTime / 4 and self.shrinkFactor > 1:
+            self.shrinkFactor //= 2
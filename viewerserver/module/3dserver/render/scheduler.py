@@ -0,0 +1,58 @@
+from wslink import schedule_callback
+
+from render.delivery import ImageDelivery, INTERACTIVE_QUALITY
+from render.stream import StreamController
+
+import time
+from typing import Dict, Optional, Set
+
+'''
+Description: Image delivery rendering at most one frame per display interval.
+    Every UpdateEvent of the application asks the delivery for a frame: mouse events,
+    RPC handlers and the progressive loading each send one. The first request after an
+    idle interval is rendered right away, the next ones only mark the view dirty and a
+    single frame is rendered at the end of the interval, with every change made meanwhile.
+    The interval is 1 / maxFrameRate, set by the client through viewport.image.animation.fps.max
+    and lowered by the stream controller.
+    Frames of an interaction animation are already paced by animate() and are not delayed.
+'''
+class RenderScheduler(ImageDelivery):
+    def __init__(
+            self,
+            decode: bool = True,
+            interactiveQuality: int = INTERACTIVE_QUALITY,
+            stillFormat: str = "jpeg",
+            streamController: Optional[StreamController] = None
+        ) -> None:
+        super().__init__(
+            decode=decode,
+            interactiveQuality=interactiveQuality,
+            stillFormat=stillFormat,
+            streamController=streamController
+        )
+        # Time of the last frame of each view
+        self.lastFrameTime: Dict[str, float] = {}
+        # Views with a frame scheduled at the end of the current interval
+        self.pendingViews: Set[str] = set()
+
+    def pushRender(self, vId, ignoreAnimation=False):
+        if ignoreAnimation:
+            self.__render(vId, ignoreAnimation)
+            return
+        if vId in self.pendingViews:
+            # Rendered with the scheduled frame
+            return
+        delay = self.lastFrameTime.get(vId, 0) + 1.0 / self.maxFrameRate - time.time()
+        if delay <= 0:
+            self.__render(vId, ignoreAnimation)
+        else:
+            self.pendingViews.add(vId)
+            schedule_callback(delay, lambda: self.__renderPending(vId))
+
+    def __renderPending(self, vId) -> None:
+        self.pendingViews.discard(vId)
+        self.__render(vId, False)
+
+    def __render(self, vId, ignoreAnimation: bool) -> None:
+        self.lastFrameTime[vId] = time.time()
+        super().pushRender(vId, ignoreAnimation)
@@ -0,0 +1,160 @@
+import atexit
+import math
+import os
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from utils.utils import isAlive
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Acknowledgement latency aimed at, in seconds
+TARGET_LATENCY = 0.15
+# Frames sent and not acknowledged yet above which no frame is sent
+MAX_FRAMES_IN_FLIGHT = 2
+# Seconds after which a frame not acknowledged is considered lost
+FRAME_TIMEOUT = 2.0
+# Stream levels from the best to the lightest: (resolution scale, JPEG quality cap, frames per second)
+# The best level does not cap the frame rate, the one set by the client applies
+STREAM_LEVELS: List[Tuple[float, int, float]] = [
+    (1.0, 100, math.inf),
+    (1.0, 80, 24),
+    (0.75, 70, 20),
+    (0.5, 60, 15),
+    (0.5, 40, 10)
+]
+# Seconds the latency must stay high, or low, before the level changes
+LEVEL_HOLD_TIME = 1.0
+# Weight of the last acknowledgement in the smoothed latency
+LATENCY_SMOOTHING = 0.3
+# Seconds after its last frame during which a session counts in the node budget
+ACTIVE_TIME = 2.0
+
+'''
+Description: Frames per second shared by the sessions of a render node. Every process marks
+    itself active with a file under root while it sends frames, and gets the node frame rate
+    divided by the number of active sessions.
+        {root}/{pid}  modified at most every ACTIVE_TIME / 4 seconds while frames are sent
+'''
+class NodeFrameBudget():
+    def __init__(self, root: str, frameRate: float) -> None:
+        self.root = root
+        self.frameRate = frameRate
+        os.makedirs(root, exist_ok=True)
+        self.path = os.path.join(root, str(os.getpid()))
+        self.lastTouch = 0.0
+        self.lastCount = 0.0
+        self.activeSessions = 1
+        atexit.register(self.close)
+
+    def touch(self) -> None:
+        now = time.time()
+        if now - self.lastTouch < ACTIVE_TIME / 4:
+            return
+        self.lastTouch = now
+        try:
+            with open(self.path, "a"):
+                os.utime(self.path)
+        except OSError as e:
+            logging.error(f"Frame budget {self.path}: {e}")
+
+    def sessionFrameRate(self) -> float:
+        now = time.time()
+        if now - self.lastCount >= 1.0:
+            # Listed at most once per second
+            self.lastCount = now
+            active = 0
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                try:
+                    if not isAlive(int(name)):
+                        os.remove(path)
+                    elif now - os.stat(path).st_mtime < ACTIVE_TIME:
+                        active += 1
+                except (OSError, ValueError):
+                    pass
+            self.activeSessions = max(1, active)
+        return self.frameRate / self.activeSessions
+
+    def close(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+'''
+Description: Adapt the image stream of a session to its client, from the time the client
+    takes to acknowledge a frame (viewport.image.push.ack). Above 1.5 * targetLatency the stream
+    goes to the next level of STREAM_LEVELS, lower resolution, quality and frame rate, below
+    targetLatency / 2 it goes back to the previous one. No frame is sent while
+    MAX_FRAMES_IN_FLIGHT frames are not acknowledged.
+    A client which never acknowledges keeps the best level and is not throttled.
+    The frame rate is also capped by the share of the session in the node budget.
+'''
+class StreamController():
+    def __init__(self, budget: Optional[NodeFrameBudget] = None, targetLatency: float = TARGET_LATENCY) -> None:
+        self.budget = budget
+        self.targetLatency = targetLatency
+        self.level = 0
+        # Smoothed acknowledgement latency, None until the client acknowledged a frame
+        self.latency: Optional[float] = None
+        self.lastLevelChange = 0.0
+        self.nextFrameId = 0
+        # Time each frame not acknowledged yet was sent
+        self.inFlight: Dict[int, float] = {}
+
+    @property
+    def resolutionScale(self) -> float:
+        return STREAM_LEVELS[self.level][0]
+
+    @property
+    def qualityCap(self) -> int:
+        return STREAM_LEVELS[self.level][1]
+
+    def frameRate(self) -> float:
+        frameRate = STREAM_LEVELS[self.level][2]
+        if self.budget is not None:
+            frameRate = min(frameRate, self.budget.sessionFrameRate())
+        return frameRate
+
+    def canSend(self) -> bool:
+        if self.latency is None:
+            return True
+        now = time.time()
+        # A frame lost by the client would block the stream
+        for frameId, sentTime in list(self.inFlight.items()):
+            if now - sentTime > FRAME_TIMEOUT:
+                del self.inFlight[frameId]
+        return len(self.inFlight) < MAX_FRAMES_IN_FLIGHT
+
+    def frameSent(self) -> int:
+        frameId = self.nextFrameId
+        self.nextFrameId += 1
+        self.inFlight[frameId] = time.time()
+        if self.budget is not None:
+            self.budget.touch()
+        return frameId
+
+    def ack(self, frameId: int) -> None:
+        sentTime = self.inFlight.pop(frameId, None)
+        if sentTime is None:
+            return
+        # Frames sent before it are displayed or dropped by the client
+        for previous in [id for id in self.inFlight if id < frameId]:
+            del self.inFlight[previous]
+
+        now = time.time()
+        latency = now - sentTime
+        self.latency = latency if self.latency is None else LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency
+
+        if now - self.lastLevelChange < LEVEL_HOLD_TIME:
+            return
+        if self.latency > 1.5 * self.targetLatency and self.level < len(STREAM_LEVELS) - 1:
+            self.level += 1
+        elif self.latency < self.targetLatency / 2 and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        self.lastLevelChange = now
+        logging.info(f"Stream level {self.level}, latency {round(self.latency * 1000)}ms")
@@ -0,0 +1,57 @@
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+import numpy as np
+
+import math
+from typing import Dict, List
+
+HISTOGRAM_BINS = 256
+# Voxels sampled at most, the volume is subsampled evenly along every axis above
+MAX_SAMPLES = 4_000_000
+# Percentiles computed, the others are interpolated between them
+PERCENTILES = [0, 0.5, 1, 2, 5, 10, 25, 50, 60, 75, 90, 95, 98, 99, 99.5, 99.9, 100]
+
+'''
+Description: Histogram and statistics of the values of a volume, computed once when it is
+    loaded on a subsampled view of its voxels.
+    isHounsfield tells whether the values look like CT Hounsfield units: air below -900 and
+    values above 300, the preset ranges of model/presets.py are only meaningful then.
+'''
+class VolumeStatistics():
+    __slots__ = ["minimum", "maximum", "mean", "std", "percentiles", "histogram", "isHounsfield", "samples"]
+    def __init__(self, sample: np.ndarray) -> None:
+        self.samples = int(sample.size)
+        self.minimum = float(sample.min())
+        self.maximum = float(sample.max())
+        self.mean = float(sample.mean(dtype=np.float64))
+        self.std = float(sample.std(dtype=np.float64))
+        self.percentiles: List[float] = [float(value) for value in np.percentile(sample, PERCENTILES)]
+        high = self.maximum if self.maximum > self.minimum else self.minimum + 1
+        self.histogram: List[int] = np.histogram(sample, bins=HISTOGRAM_BINS, range=(self.minimum, high))[0].tolist()
+        self.isHounsfield = self.minimum <= -900 and self.maximum >= 300
+
+    @staticmethod
+    def fromImageData(imageData: vtk.vtkImageData) -> "VolumeStatistics":
+        shape = tuple(reversed(imageData.GetDimensions())) # (z, y, x)
+        array = vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
+        stride = max(1, math.ceil((array.size / MAX_SAMPLES) ** (1 / 3)))
+        # Copied once as float32: np.percentile partitions its input
+        sample = array[::stride, ::stride, ::stride].astype(np.float32).reshape(-1)
+        return VolumeStatistics(sample)
+
+    def percentile(self, percent: float) -> float:
+        return float(np.interp(percent, PERCENTILES, self.percentiles))
+
+    def toDict(self) -> Dict:
+        return {
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+            "mean": self.mean,
+            "std": self.std,
+            "percentiles": dict(zip([str(percent) for percent in PERCENTILES], self.percentiles)),
+            # Bins of equal width between minimum and maximum
+            "histogram": self.histogram,
+            "isHounsfield": self.isHounsfield,
+            "samples": self.samples
+        }
@@ -15,4 +15,13 @@ def getInfoMemory() -> Optional[tuple]:
         totalMemory, usedMemory, freeMemory = map(int, os.popen('free -t -m').readlines()[-1].split()[1:])
         return usedMemory
     except:
-        return None
\ No newline at end of file
+        return None
+
+def isAlive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
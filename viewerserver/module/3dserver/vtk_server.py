@@ -35,24 +35,30 @@ if '--virtual-env' in sys.argv:
 # from __future__ import absolute_import, division, print_function
 
 from wslink import server
+from wslink import schedule_callback
 
 from vtk.web import wslink as vtk_wslink
 from vtk.web import protocols as vtk_protocols
 
 import vtk
 from protocol.vtk_protocol import Dicom3D
+from render.scheduler import RenderScheduler
+from render.delivery import COMPRESSION, INTERACTIVE_QUALITY
+from render.stream import NodeFrameBudget, StreamController
 
 import requests
-from pydicom.dataset import Dataset
-from typing import Tuple, Dict
-from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+import asyncio
 import time
 import threading
 import json
 import enum
 import logging
 
-from utils.utils import MyAuth
+from cache.series_cache import SeriesCache
+from cache.volume_cache import writeVolume
+from download.series_downloader import SeriesDownloader
+from loader.progressive_volume import ProgressiveVolume
 from dotenv import load_dotenv
 
 load_dotenv(verbose=True)
@@ -61,10 +67,11 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(level
 # Server class
 # =============================================================================
 
-class Status(enum.Enum):
-    NONE = "NONE"
-    DOWNLOADING = "DOWNLOADING"
-    DONE = "DONE"
+class RetrieveMode(enum.Enum):
+    # One WADO-RS multipart request for the whole series
+    SERIES = "series"
+    # One WADO-URI request per instance
+    INSTANCES = "instances"
 
 class _Server(vtk_wslink.ServerProtocol):
     # Defaults
@@ -72,6 +79,28 @@ class _Server(vtk_wslink.ServerProtocol):
     dicom3d = Dicom3D()
     view = None
     dicomDataPath = None
+    # Published series directory, None for a series which is not cached
+    seriesPath = None
+    seriesCache = None
+    seriesKey = None
+    # Volume filled while the series is downloading, None when it is read from disk afterwards
+    progressiveVolume = None
+    # Set once the client can be served: the volume is allocated or the series is on disk
+    dataReady = threading.Event()
+    # Started by launcher/warm_launcher.py before a series is assigned
+    warm = False
+    sessionTimeout = 20
+    # Encoding of the frames sent to the client
+    interactiveQuality = INTERACTIVE_QUALITY
+    stillImageFormat = "jpeg"
+    # Frame rate budget of the node, None without limit
+    frameBudget = None
+    instance = None
+    clients = 0
+    # Event loop of the server, for the threads
+    loop = None
+    # Exit scheduled while no client is connected
+    idleExit = None
 
     @staticmethod
     def add_arguments(parser) -> None:
@@ -98,6 +127,67 @@ class _Server(vtk_wslink.ServerProtocol):
             default=None,
             help="session2D"
         )
+        parser.add_argument(
+            "--downloadWorkers",
+            type=int,
+            default=8,
+            help="Number of concurrent instance downloads"
+        )
+        parser.add_argument(
+            "--retrieveMode",
+            type=str,
+            default=RetrieveMode.SERIES.value,
+            choices=[mode.value for mode in RetrieveMode],
+            help="Retrieve the series with one WADO-RS request or instance by instance"
+        )
+        parser.add_argument(
+            "--cacheDir",
+            type=str,
+            default="./viewerserver/module/3dserver/data/cache",
+            help="Directory of the series cache shared by the 3D servers of the node"
+        )
+        parser.add_argument(
+            "--cacheQuota",
+            type=float,
+            default=20,
+            help="Size in GB above which the least recently used series are evicted"
+        )
+        parser.add_argument(
+            "--renderThreads",
+            type=int,
+            default=0,
+            help="Threads used by VTK for the rendering of this session, 0 for one per core"
+        )
+        parser.add_argument(
+            "--interactiveQuality",
+            type=int,
+            default=INTERACTIVE_QUALITY,
+            help="JPEG quality of the frames sent while the view is dragged"
+        )
+        parser.add_argument(
+            "--stillImageFormat",
+            type=str,
+            default="jpeg",
+            choices=list(COMPRESSION),
+            help="Format of the frames sent when the view is still, png for lossless frames"
+        )
+        parser.add_argument(
+            "--nodeFrameRate",
+            type=float,
+            default=240,
+            help="Frames per second shared by the sessions of the node sending frames, 0 for no limit"
+        )
+        parser.add_argument(
+            "--warm",
+            action="store_true",
+            help="Start without a series and wait for the launcher to assign one on stdin"
+        )
+        parser.add_argument(
+            "--sessionTimeout",
+            type=int,
+            default=20,
+            help="In warm mode, seconds without client after which the process exits"
+        )
 
     @staticmethod
     def get_store_url(
@@ -129,131 +219,186 @@ class _Server(vtk_wslink.ServerProtocol):
         store: Dict,
         studyUID: str,
         seriesUID: str,
-        dicomDataPath: str,
-        statusFilePath: str,
-        threadCount: int = 4
+        seriesCache: SeriesCache,
+        threadCount: int = 4,
+        retrieveMode: str = "series"
     ) -> None:
-        store_url = store['store_url']
-        url = f"{store_url}/studies/{studyUID}/series/{seriesUID}/metadata"
+        key = SeriesCache.key(studyUID, seriesUID)
+        _Server.seriesCache = seriesCache
+        _Server.seriesKey = key
         try:
-            response = requests.get(
-                url,
-                auth = MyAuth(store["store_authentication"])
-            )
-            if response.status_code == 200:
-                start = time.time()
-                if _Server.get_data_status(statusFilePath) == Status.NONE.value:
-                    _Server.add_data_path_and_data_status(statusFilePath, Status.DOWNLOADING.value)
-
-                    metadatas = response.json()
-                    futures = [0 for _ in range(threadCount)]
-                    chunkSize = len(metadatas) // threadCount
-
-                    with ThreadPoolExecutor(max_workers=threadCount) as executor:
-                        for i in range(threadCount):
-                            startIndex = i * chunkSize
-                            endIndex = (i + 1) * chunkSize if i != threadCount - 1 else len(metadatas)
-                            if startIndex < endIndex:
-                                futures[i] = executor.submit(
-                                    _Server.save_instances,
-                                    f"thread {i}",
-                                    (startIndex, endIndex),
-                                    metadatas,
-                                    store,
-                                    studyUID,
-                                    seriesUID,
-                                    dicomDataPath
-                                )
-                        executor.shutdown(wait=True)
-                    _Server.add_data_path_and_data_status(statusFilePath, Status.DONE.value)
-                else:
-                    while _Server.get_data_status(statusFilePath) == Status.DOWNLOADING.value:
-                        # print("Waiting 5 seconds...")
-                        logging.info("Waiting 5 seconds... because another process is downloading data...")
-                        time.sleep(5)
-                _Server.dicomDataPath = dicomDataPath
-                # print("Data finished")
+            start = time.time()
+            seriesCache.reference(key)
+            seriesPath = seriesCache.lookup(key)
+            if seriesPath is None:
+                # Blocks while another process downloads the same series
+                with seriesCache.lock(key):
+                    seriesPath = seriesCache.lookup(key)
+                    if seriesPath is None:
+                        seriesPath = _Server.download_series(store, studyUID, seriesUID, seriesCache, key, threadCount, retrieveMode)
+            else:
+                logging.info("Series found in the cache")
+            if seriesPath is not None:
+                if seriesPath == seriesCache.path(key):
+                    _Server.seriesPath = seriesPath
+                _Server.dicomDataPath = os.path.join(seriesPath, "data")
+                if _Server.progressiveVolume is not None:
+                    _Server.progressiveVolume.finish(_Server.dicomDataPath, _Server.seriesPath)
                 stop = time.time()
                 logging.info("Data is finished - time: " + str(round(stop - start, 3)) + "s")
-            else:
-                # print(f"{url}\nStatus Code: {response.status_code}")
-                logging.error(f"{url} - {response.status_code}")
         except Exception as e:
             # print(f"Error: {e}")
             logging.error(e)
-    
+            if _Server.progressiveVolume is not None:
+                _Server.progressiveVolume.finish(_Server.dicomDataPath)
+        finally:
+            _Server.dataReady.set()
+
     @staticmethod
-    def save_instances(
-        name: str,
-        indexs: Tuple, 
-        metadatas: Dict, 
+    def download_series(
         store: Dict,
-        studyUID: str, 
-        seriesUID: str, 
-        dicomDataPath: str
-    ) -> None:
-        store_url = store["store_url"].split("-")[0]
+        studyUID: str,
+        seriesUID: str,
+        seriesCache: SeriesCache,
+        key: str,
+        threadCount: int,
+        retrieveMode: str
+    ) -> Optional[str]:
+        '''
+        Description: Download a series into a temporary directory of the cache and publish it.
+            A series with missing instances is used by this session only, never published.
+        Return: the series directory, None if the metadata could not be retrieved
+        '''
+        tmpPath = seriesCache.createTmpDir(key)
+        dicomDataPath = os.path.join(tmpPath, "data")
+        os.makedirs(dicomDataPath)
+
+        downloader = SeriesDownloader(store, studyUID, seriesUID, dicomDataPath, workers=threadCount)
         try:
-            for i in range(indexs[0], indexs[1]):
-                ds = Dataset.from_json(metadatas[i])
-                objectUID = ds.SOPInstanceUID
-                response = requests.get(
-                    store_url,
-                    params={
-                        "studyUID": studyUID,
-                        "seriesUID": seriesUID,
-                        "objectUID": objectUID,
-                        "requestType": "WADO",
-                        "contentType": "application/dicom"
-                    },
-                    auth = MyAuth(store["store_authentication"])
-                )
-                if response.status_code == 200:
-                    dicomFile = f"/{objectUID}.dcm"
-                    bytes = response.content
-                    with open(dicomDataPath + dicomFile, "wb") as file:
-                        file.write(bytes)
-                else:
-                    # print(f"{response.url}\nStatus Code: {response.status_code}")
-                    logging.info(f"{response.url} - {response.status_code}")
-            # print(f"{name}: Done")
-            logging.info(f"{name}: Done")
-        except Exception as e:
-            # print(f"Error: {e}")
-            logging.error(e)
+            metadatas = downloader.getMetadata()
+            if metadatas is None:
+                return None
+
+            volume = ProgressiveVolume.fromMetadata(metadatas)
+            if volume is not None:
+                # Serve the client right away and fill the volume as instances arrive
+                downloader.onInstance = volume.addSlice
+                _Server.dicomDataPath = dicomDataPath
+                _Server.progressiveVolume = volume
+                _Server.dataReady.set()
+                objectUIDs = volume.downloadOrder()
+            else:
+                logging.info("The series can not be loaded progressively")
+                objectUIDs = [SeriesDownloader.objectUID(metadata) for metadata in metadatas]
+            if retrieveMode == RetrieveMode.SERIES.value:
+                # One request for the whole series, then fetch whatever it did not deliver
+                received = set(downloader.downloadSeries())
+                logging.info(f"{len(received)}/{len(objectUIDs)} instances retrieved with the series request")
+                objectUIDs = [objectUID for objectUID in objectUIDs if objectUID not in received]
+            failed = downloader.downloadInstances(objectUIDs)
+        finally:
+            downloader.close()
 
-    @staticmethod
-    def add_data_path_and_data_status(statusFilePath: str, dataStatus: str) -> None:
-        with open(statusFilePath, mode='r+') as file:
-            data = json.load(file)
-            data["status"] = dataStatus
-            file.seek(0)
-            json.dump(data, file, indent=4)
-            file.truncate()
+        if failed:
+            logging.error(f"{len(failed)}/{len(objectUIDs)} instances could not be downloaded, the series is not cached")
+            return tmpPath
+        if volume is not None and not volume.failed:
+            # Opening the series again maps this file instead of reading the instances
+            writeVolume(tmpPath, volume.imageData)
+        return seriesCache.publish(key, tmpPath)
 
     @staticmethod
-    def get_data_status(statusFilePath: str) -> str:
-        with open(statusFilePath, mode='r') as file:
-            data = json.load(file)
-        return data["status"]
+    def wait_assignment(args, seriesCache: SeriesCache) -> None:
+        '''
+        Description: Warm process: wait for the launcher to send the session on stdin,
+            as one JSON line with studyUUID, seriesUUID, session2D and secret, then download the series.
+        '''
+        line = sys.stdin.readline()
+        if not line:
+            logging.error("The launcher closed stdin before assigning a session")
+            os._exit(1)
+        assignment = json.loads(line)
+        args.studyUUID = assignment["studyUUID"]
+        args.seriesUUID = assignment["seriesUUID"]
+        args.session2D = assignment["session2D"]
+        if assignment.get("secret"):
+            _Server.authKey = assignment["secret"]
+            if _Server.instance is not None:
+                _Server.instance.updateSecret(_Server.authKey)
+        # Expected by the launcher before it returns the session to the client
+        print("Session assigned", flush=True)
+        # The client may never connect, the process would then wait for the --timeout of the pool
+        _Server.loop.call_soon_threadsafe(_Server.schedule_idle_exit)
+
+        store = _Server.get_store_url(args.session2D, args.studyUUID)
+        _Server.save_all_instances(store, args.studyUUID, args.seriesUUID, seriesCache, args.downloadWorkers, args.retrieveMode)
 
     @staticmethod
     def configure(args) -> None:
         # Standard args
         _Server.authKey = args.authKey
+        _Server.warm = args.warm
+        _Server.sessionTimeout = args.sessionTimeout
+        _Server.interactiveQuality = args.interactiveQuality
+        _Server.stillImageFormat = args.stillImageFormat
+        if args.nodeFrameRate > 0:
+            # Next to the series cache, shared by the 3D servers of the node
+            _Server.frameBudget = NodeFrameBudget(os.path.join(args.cacheDir, "streams"), args.nodeFrameRate)
+
+        if args.renderThreads > 0:
+            # Every session is a process, without a budget each one would use all the cores
+            vtk.vtkSMPTools.Initialize(args.renderThreads)
+            vtk.vtkMultiThreader.SetGlobalMaximumNumberOfThreads(args.renderThreads)
 
     def onConnect(self, request, client_id) -> None:
-        while self.dicomDataPath is None:
-            pass
-        else:
-            self.dicom3d.dicomDataPath = self.dicomDataPath
+        _Server.clients += 1
+        if _Server.idleExit is not None:
+            _Server.idleExit.cancel()
+            _Server.idleExit = None
+        # Waited off the event loop, vtk.initialize waits for it
+        self.dicom3d.dataReady = asyncio.ensure_future(self.receive_data())
+
+    async def receive_data(self) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, _Server.dataReady.wait)
+        self.dicom3d.dicomDataPath = _Server.dicomDataPath
+        self.dicom3d.seriesPath = _Server.seriesPath
+        self.dicom3d.seriesCache = _Server.seriesCache
+        self.dicom3d.seriesKey = _Server.seriesKey
+        volume = _Server.progressiveVolume
+        if volume is not None and not volume.finished:
+            # Only while it is downloading, a reconnecting client would otherwise get a volume
+            # already released, and the cropping would stay disabled
+            self.dicom3d.progressiveVolume = volume
+
+    def onClose(self, client_id) -> None:
+        _Server.clients -= 1
+        if _Server.warm and _Server.clients == 0:
+            # A warm process serves a single session, the launcher starts a fresh one
+            _Server.schedule_idle_exit()
+
+    @staticmethod
+    def schedule_idle_exit() -> None:
+        _Server.idleExit = schedule_callback(_Server.sessionTimeout, _Server.exit_if_idle)
+
+    @staticmethod
+    def exit_if_idle() -> None:
+        if _Server.clients == 0:
+            logging.info("Session is over, exiting")
+            sys.exit(0)
 
     def initialize(self) -> None:
+        _Server.instance = self
         # Bring Used Components
         # A list of LinkProtocol provide rpc and publish functionality
         self.registerVtkWebProtocol(vtk_protocols.vtkWebMouseHandler())
         self.registerVtkWebProtocol(vtk_protocols.vtkWebViewPort())
-        self.registerVtkWebProtocol(vtk_protocols.vtkWebPublishImageDelivery(decode=False))
+        # Renders at most one frame per display interval for all the render requests
+        self.registerVtkWebProtocol(RenderScheduler(
+            decode=False,
+            interactiveQuality=_Server.interactiveQuality,
+            stillFormat=_Server.stillImageFormat,
+            streamController=StreamController(_Server.frameBudget)
+        ))
         
         # Custom API
         self.registerVtkWebProtocol(self.dicom3d)
@@ -301,21 +446,22 @@ if __name__ == "__main__":
     args = parser.parse_args()
     _Server.configure(args)
 
-    store = _Server.get_store_url(args.session2D, args.studyUUID)
+    seriesCache = SeriesCache(args.cacheDir, int(args.cacheQuota * 1024 ** 3))
 
-    dataPath = f"./viewerserver/module/3dserver/data/{args.studyUUID}/{args.seriesUUID}"
-    dicomDataPath = dataPath + "/data"
-    statusFilePath = dataPath + "/status.json"
-
-    if not os.path.exists(dataPath):
-        os.makedirs(dicomDataPath)
-        with open(statusFilePath, mode='w') as file:
-            json.dump({"status": Status.NONE.value}, file, indent=4)
-
-    thread_download_data = threading.Thread(
-        target=_Server.save_all_instances,
-        args=(store, args.studyUUID, args.seriesUUID, dicomDataPath, statusFilePath, 8,)
-    )
+    if args.warm:
+        # The loop run by start_webserver
+        _Server.loop = asyncio.get_event_loop()
+        thread_download_data = threading.Thread(
+            target=_Server.wait_assignment,
+            args=(args, seriesCache,),
+            daemon=True
+        )
+    else:
+        store = _Server.get_store_url(args.session2D, args.studyUUID)
+        thread_download_data = threading.Thread(
+            target=_Server.save_all_instances,
+            args=(store, args.studyUUID, args.seriesUUID, seriesCache, args.downloadWorkers, args.retrieveMode,)
+        )
     thread_download_data.start()
 
     server.start_webserver(
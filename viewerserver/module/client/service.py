@@ -20,7 +20,9 @@ class RequestService:
 
     async def get_new_viewer_url(self, obj: ViewerRequestDTOCreate) -> str:
         session_id = str(uuid4())
-    
+        expired_time = datetime.today() + timedelta(seconds=obj.expireIn)
+
+        sessions = []
         for study_iuid in obj.studyUIDs:
             store = obj.studyUIDs[study_iuid]
             json = {
@@ -32,11 +34,12 @@ class RequestService:
                 "store_authentication": store.authentication,
                 "store_url": store.url,
                 "study_iuid": study_iuid,
-                "expired_time": datetime.today() + timedelta(seconds=obj.expireIn)
+                "expired_time": expired_time
             }
-            session = InSessionSchema(**json)
+            sessions.append(InSessionSchema(**json))
 
-            print(await self._repository.create(session))
+        # One INSERT and one commit for all studies of the link
+        await self._repository.create_many(sessions)
 
         url = "/viewer/index.html?session=" + session_id + "&studies=" + ",".join(obj.studyUIDs)
         return url if obj.userID is None else url + "&userID=" + obj.userID
@@ -49,7 +52,9 @@ class RequestService:
             expireIn = min(expireIn, obj.expiredIn)
 
         sharedSessionID = str(uuid4())
+        expired_time = datetime.today() + timedelta(seconds=expireIn)
 
+        sharedSessions = []
         sharedStudyIUIDs = []
         for session in sessions:
             json = {
@@ -61,12 +66,14 @@ class RequestService:
                 "store_authentication": session.store_authentication,
                 "store_url": session.store_url,
                 "study_iuid": session.study_iuid,
-                "expired_time": datetime.today() + timedelta(seconds=expireIn)
+                "expired_time": expired_time
             }
-            # Create new session
-            await self._repository.create(InSessionSchema(**json))
+            sharedSessions.append(InSessionSchema(**json))
 
             sharedStudyIUIDs.append(session.study_iuid)
 
+        # Create new sessions
+        await self._repository.create_many(sharedSessions)
+
         url = "/viewer/index.html?session=" + sharedSessionID + "&studies=" + ",".join(sharedStudyIUIDs)
         return url if obj.anonymize is None else url + "ano=1"
\ No newline at end of file
@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Tuple
+
+from ...config.settings import settings
+from .schema import SessionSchema
+
+class SessionCache:
+    """
+    In-process TTL cache of resolved viewer sessions, keyed by session id.
+    An entry is dropped once its TTL elapsed or the session's expired_time passed,
+    so an expired session is never served from the cache.
+    """
+
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[SessionSchema, float]]" = OrderedDict()
+
+    def get(self, id: str) -> Optional[SessionSchema]:
+        entry = self._entries.get(id)
+        if entry is None:
+            return None
+        session, cached_at = entry
+        if time.monotonic() - cached_at > self._ttl or session.expired_time <= datetime.today():
+            del self._entries[id]
+            return None
+        self._entries.move_to_end(id)
+        return session
+
+    def put(self, session: SessionSchema) -> None:
+        if self._max_entries <= 0:
+            return
+        self._entries[session.id] = (session, time.monotonic())
+        self._entries.move_to_end(session.id)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def purge_expired(self, now: datetime) -> None:
+        expired = [id for id, (session, _) in self._entries.items() if session.expired_time <= now]
+        for id in expired:
+            del self._entries[id]
+
+session_cache = SessionCache(
+    ttl=settings.SESSION_CACHE_TTL,
+    max_entries=settings.SESSION_CACHE_MAX_ENTRIES
+)
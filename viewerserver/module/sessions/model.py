@@ -20,4 +20,5 @@ class Session(BaseModel):
     
     study_iuid = Column(String)
     
-    expired_time = Column(DateTime)
+    # Indexed for the periodic expiry sweep
+    expired_time = Column(DateTime, index=True)
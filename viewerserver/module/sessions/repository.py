@@ -3,6 +3,7 @@ from typing import Type
 from sqlalchemy import select, delete
 
 from ...db.repository.base_repository import BaseRepository
+from .cache import session_cache
 from .model import Session
 from .schema import InSessionSchema, SessionSchema
 
@@ -37,11 +38,29 @@ class SessionsRepository(BaseRepository[InSessionSchema, SessionSchema, Session]
         result = [self._schema.from_orm(entry) for entry in entries]
         return result
 
-    async def remove_expired_2dviewer_session(self) -> None:
-        allViewerSession = await self.get_all_2dviewer_session()
-        for record in allViewerSession:
-            if (datetime.today() - record.expired_time).total_seconds() >= 0:
-                await self.remove_2dviewer_session_by_id(record.id)
+    async def remove_expired_2dviewer_session(self, batch_size: int = 1000) -> int:
+        """
+        Delete every session whose expired_time has passed, batch_size rows per statement
+        and transaction so a large backlog does not hold the connection for long.
+        Return the number of deleted rows.
+        """
+        now = datetime.today()
+        removed = 0
+        while True:
+            expired = select(Session.id).where(Session.expired_time <= now).limit(batch_size)
+            statement = (
+                delete(Session)
+                .where(Session.id.in_(expired))
+                .execution_options(synchronize_session=False)
+            )
+            result = await self._db_session.execute(statement)
+            await self._db_session.commit()
+            removed += result.rowcount
+            if result.rowcount < batch_size:
+                break
+
+        session_cache.purge_expired(now)
+        return removed
 
     async def remove_2dviewer_session_by_id(self, id: str) -> None:
         statement = (
@@ -1,8 +1,11 @@
 import asyncio
+import logging
 
 from ...db.db import get_db
 from .repository import SessionsRepository
 
+logger = logging.getLogger(__name__)
+
 async def remove_expired_sessions():
     while True:
         # test
@@ -10,4 +13,6 @@ async def remove_expired_sessions():
         # sleep for 60 seconds after running above code
         await asyncio.sleep(60)
         async for db in get_db():
-            await SessionsRepository(db).remove_expired_2dviewer_session()
\ No newline at end of file
+            removed = await SessionsRepository(db).remove_expired_2dviewer_session()
+            if removed:
+                logger.info(f"Removed {removed} expired sessions")
\ No newline at end of file
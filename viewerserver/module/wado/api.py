@@ -1,31 +1,56 @@
-from typing import Union
+from typing import AsyncIterator, Union
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse, Response
+import httpx
+from fastapi import APIRouter, Depends, Header
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ...db.db import get_db
 
+from .cache import frame_cache
 from .service import WadoService
 
 router = APIRouter(prefix="/ws/rest/wado-rs", tags=['wado-rs'])
 
+# Entity headers forwarded as-is, Content-Type carries the multipart boundary
+PROXY_HEADERS = ("content-type", "content-length", "content-encoding")
+
+async def _iter_upstream(resp: httpx.Response) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in resp.aiter_raw():
+            yield chunk
+    finally:
+        await resp.aclose()
+
+def _streaming_response(resp: httpx.Response) -> Response:
+    """
+    Forward an upstream response chunk by chunk instead of buffering the whole body.
+    Raw (still encoded) bytes are relayed, so Content-Length and Content-Encoding stay valid.
+    The upstream request carries the Accept-Encoding of the client, see WadoService._get.
+    """
+    headers = {name: resp.headers[name] for name in PROXY_HEADERS if name in resp.headers}
+    return StreamingResponse(_iter_upstream(resp), status_code=resp.status_code, headers=headers)
+
+@router.get("/cache/stats")
+async def get_cache_stats() -> dict:
+    return frame_cache.stats()
+
 @router.get("/{sessionID}/studies/{studyUID}/series")
-async def get_study(sessionID: str, studyUID: str, db: AsyncSession = Depends(get_db)) -> Response:
-    resp = await WadoService(db).get_study(sessionID, studyUID)
-    return JSONResponse(resp.json())
+async def get_study(sessionID: str, studyUID: str, accept_encoding: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_db)) -> Response:
+    resp = await WadoService(db).get_study(sessionID, studyUID, stream=True, accept_encoding=accept_encoding)
+    return _streaming_response(resp)
 
 @router.get("/{sessionID}/studies/{studyUID}/series/{seriesUID}/metadata")
-async def get_series_metadata(sessionID: str, studyUID: str, seriesUID: str, db: AsyncSession = Depends(get_db)) -> Response:
-    resp = await WadoService(db).get_series_metadata(sessionID, studyUID, seriesUID)
-    return Response(content = resp.content, media_type="application/octet-stream")
+async def get_series_metadata(sessionID: str, studyUID: str, seriesUID: str, accept_encoding: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_db)) -> Response:
+    resp = await WadoService(db).get_series_metadata(sessionID, studyUID, seriesUID, stream=True, accept_encoding=accept_encoding)
+    return _streaming_response(resp)
 
 @router.get("/{sessionID}/studies/{studyUID}/series/{seriesUID}/instances/{sopUID}/frames/{frames}")
-async def get_frame(sessionID: str, studyUID: str, seriesUID: str, sopUID: str, frames: str, db: AsyncSession = Depends(get_db)) -> Response:
-    resp = await WadoService(db).get_frame(sessionID, studyUID, seriesUID, sopUID, frames)
-    return Response(content = resp.content, media_type="application/octet-stream")
+async def get_frame(sessionID: str, studyUID: str, seriesUID: str, sopUID: str, frames: str, accept: Union[str, None] = Header(default=None), accept_encoding: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_db)) -> Response:
+    resp = await WadoService(db).get_frame(sessionID, studyUID, seriesUID, sopUID, frames, accept, stream=True, accept_encoding=accept_encoding)
+    return _streaming_response(resp)
 
 @router.get("/{sessionID}/studies/{studyUID}/series/{seriesUID}/thumbnail")
-async def get_series_thumbnail(sessionID: str, studyUID: str, seriesUID: str, q: Union[str, None] = None, viewport: str = "", db: AsyncSession = Depends(get_db)) -> Response:
-    resp = await WadoService(db).get_series_thumbnail(sessionID, studyUID, seriesUID, q, viewport)
-    return Response(content = resp.content, media_type="application/octet-stream")
\ No newline at end of file
+async def get_series_thumbnail(sessionID: str, studyUID: str, seriesUID: str, q: Union[str, None] = None, viewport: str = "", accept_encoding: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_db)) -> Response:
+    resp = await WadoService(db).get_series_thumbnail(sessionID, studyUID, seriesUID, q, viewport, stream=True, accept_encoding=accept_encoding)
+    return _streaming_response(resp)
@@ -0,0 +1,276 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple, Optional
+
+import httpx
+from fastapi.concurrency import run_in_threadpool
+
+from ...config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two scans of the disk tier, which also holds the entries of the other workers
+DISK_SCAN_INTERVAL = 30.0
+# Share of the disk quota the disk tier is brought back to once over it
+DISK_EVICT_TARGET = 0.9
+
+class CachedFrame(NamedTuple):
+    content_type: str
+
+    content_encoding: str
+
+    content: bytes
+
+class _CachingStream(httpx.AsyncByteStream):
+    """
+    Relays the upstream stream unchanged and hands the whole body to `on_complete`
+    once it has been read to the end without exceeding `max_bytes`.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, max_bytes: int, on_complete: Callable[[bytes], Awaitable[None]]) -> None:
+        self._stream = stream
+        self._max_bytes = max_bytes
+        self._on_complete = on_complete
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        chunks = []
+        size = 0
+        async for chunk in self._stream:
+            if chunks is not None:
+                size += len(chunk)
+                if size > self._max_bytes:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            await self._on_complete(b"".join(chunks))
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+
+class FrameCache:
+    """
+    Content-addressed cache of WADO-RS frame responses.
+    Entries are keyed by (store_url, study, series, SOP, frames, transfer syntax, accepted
+    encodings) and kept in a bounded in-memory LRU tier, with an optional on-disk tier
+    evicted by total size.
+    The memory tier is per worker process, the disk tier can be shared by all workers.
+    The disk quota is for the whole directory: a worker scans it at most every
+    DISK_SCAN_INTERVAL seconds, and whenever its own count is over quota, then evicts the
+    least recently used entries of every worker. A disk hit touches its file, so the order
+    rebuilt from the modification times is the order of use.
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int,
+        max_entry_bytes: int,
+        disk_path: Optional[str] = None,
+        disk_bytes: int = 0
+    ) -> None:
+        self._memory_bytes = memory_bytes
+        self._max_entry_bytes = max_entry_bytes
+        self._memory: "OrderedDict[str, CachedFrame]" = OrderedDict()
+        self._memory_size = 0
+
+        self._disk_path = disk_path if disk_path and disk_bytes > 0 else None
+        self._disk_bytes = disk_bytes
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_size = 0
+        self._disk_lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._last_scan = 0.0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self._disk_path is not None:
+            self._scan_disk()
+            logger.info(f"Frame cache: {len(self._disk)} entries ({self._disk_size} bytes) on disk")
+
+    @staticmethod
+    def key(store_url: str, studyUID: str, seriesUID: str, sopUID: str, frames: str, transfer_syntax: Optional[str], accept_encoding: Optional[str] = None) -> str:
+        raw = "\n".join([store_url, studyUID, seriesUID, sopUID, frames, transfer_syntax or "", accept_encoding or "identity"])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def _size(frame: CachedFrame) -> int:
+        return len(frame.content) + len(frame.content_type) + len(frame.content_encoding)
+
+    async def get(self, key: str) -> Optional[CachedFrame]:
+        frame = self._memory.get(key)
+        if frame is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return frame
+
+        if self._disk_path is not None:
+            frame = await run_in_threadpool(self._read_disk, key)
+            if frame is not None:
+                self.disk_hits += 1
+                self._put_memory(key, frame)
+                return frame
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, frame: CachedFrame) -> None:
+        if self._size(frame) > self._max_entry_bytes:
+            return
+        self._put_memory(key, frame)
+        if self._disk_path is not None:
+            await run_in_threadpool(self._write_disk, key, frame)
+
+    async def store(self, key: str, resp: httpx.Response) -> httpx.Response:
+        """
+        Cache a successful upstream response. A streamed response is cached while it
+        is relayed, once its last chunk went through.
+        """
+        if resp.status_code != 200:
+            return resp
+
+        content_type = resp.headers.get("content-type", "application/octet-stream")
+        if resp.is_stream_consumed:
+            await self.put(key, CachedFrame(content_type, "", resp.content))
+            return resp
+
+        content_encoding = resp.headers.get("content-encoding", "")
+        async def on_complete(content: bytes) -> None:
+            await self.put(key, CachedFrame(content_type, content_encoding, content))
+        resp.stream = _CachingStream(resp.stream, self._max_entry_bytes, on_complete)
+        return resp
+
+    @staticmethod
+    def response(frame: CachedFrame) -> httpx.Response:
+        headers = {"content-type": frame.content_type, "content-length": str(len(frame.content))}
+        if frame.content_encoding:
+            headers["content-encoding"] = frame.content_encoding
+        return httpx.Response(200, headers=headers, stream=httpx.ByteStream(frame.content))
+
+    def stats(self) -> dict:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_size
+        }
+
+    def _put_memory(self, key: str, frame: CachedFrame) -> None:
+        size = self._size(frame)
+        if size > self._memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= self._size(previous)
+        self._memory[key] = frame
+        self._memory_size += size
+        while self._memory_size > self._memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= self._size(evicted)
+            self.evictions += 1
+
+    def _disk_file(self, key: str) -> str:
+        return os.path.join(self._disk_path, key[:2], key)
+
+    def _scan_disk(self) -> None:
+        entries = []
+        for root, _, files in os.walk(self._disk_path):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+        disk = OrderedDict((key, size) for _, key, size in sorted(entries))
+        with self._disk_lock:
+            self._disk = disk
+            self._disk_size = sum(disk.values())
+            self._last_scan = time.monotonic()
+
+    def _read_disk(self, key: str) -> Optional[CachedFrame]:
+        with self._disk_lock:
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(self._disk_file(key), "rb") as file:
+                header = file.readline().decode().rstrip("\n")
+                content = file.read()
+        except FileNotFoundError:
+            # Evicted by another worker
+            with self._disk_lock:
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_size -= size
+            return None
+        try:
+            # Most recently used on the next scan
+            os.utime(self._disk_file(key))
+        except OSError:
+            pass
+        content_type, _, content_encoding = header.partition("\t")
+        return CachedFrame(content_type, content_encoding, content)
+
+    def _write_disk(self, key: str, frame: CachedFrame) -> None:
+        path = self._disk_file(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as file:
+                file.write(f"{frame.content_type}\t{frame.content_encoding}\n".encode())
+                file.write(frame.content)
+            # Atomic publish, readers never see a partially written entry
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            logger.error(f"Frame cache: cannot write {path} - {e}")
+            return
+
+        with self._disk_lock:
+            previous = self._disk.pop(key, None)
+            if previous is not None:
+                self._disk_size -= previous
+            self._disk[key] = size
+            self._disk_size += size
+            scan = self._disk_size > self._disk_bytes or time.monotonic() - self._last_scan >= DISK_SCAN_INTERVAL
+        if scan and self._scan_lock.acquire(blocking=False):
+            # Entries written by the other workers count against the quota too
+            try:
+                self._scan_disk()
+            finally:
+                self._scan_lock.release()
+
+        evicted = []
+        with self._disk_lock:
+            if self._disk_size <= self._disk_bytes:
+                return
+            while self._disk_size > self._disk_bytes * DISK_EVICT_TARGET and len(self._disk) > 1:
+                evicted_key, evicted_size = self._disk.popitem(last=False)
+                self._disk_size -= evicted_size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._disk_file(evicted_key))
+            except FileNotFoundError:
+                pass
+            self.evictions += 1
+
+frame_cache = FrameCache(
+    memory_bytes=settings.WADO_FRAME_CACHE_MEMORY_BYTES,
+    max_entry_bytes=settings.WADO_FRAME_CACHE_MAX_ENTRY_BYTES,
+    disk_path=settings.WADO_FRAME_CACHE_DISK_PATH,
+    disk_bytes=settings.WADO_FRAME_CACHE_DISK_BYTES
+)
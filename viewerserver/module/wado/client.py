@@ -0,0 +1,63 @@
+from typing import Dict
+from urllib.parse import urlsplit
+
+import httpx
+
+from ...config.settings import settings
+
+class WadoClientPool:
+    """
+    Shared async HTTP clients for the upstream WADO-RS stores.
+    One keep-alive connection pool is kept per store origin (scheme://host:port),
+    so every session pointing at the same PACS reuses the same connections.
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        timeout: float,
+        http2: bool = False
+    ) -> None:
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self._timeout = httpx.Timeout(timeout)
+        self._http2 = http2
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    @staticmethod
+    def _origin(store_url: str) -> str:
+        url = urlsplit(store_url)
+        return f"{url.scheme}://{url.netloc}"
+
+    def get(self, store_url: str) -> httpx.AsyncClient:
+        origin = self._origin(store_url)
+        client = self._clients.get(origin)
+        if client is None or client.is_closed:
+            # max_connections bounds the concurrency towards a single upstream,
+            # extra requests wait for a free connection instead of opening new ones
+            client = httpx.AsyncClient(
+                limits=self._limits,
+                timeout=self._timeout,
+                http2=self._http2
+            )
+            self._clients[origin] = client
+        return client
+
+    async def aclose(self) -> None:
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+wado_clients = WadoClientPool(
+    max_connections=settings.WADO_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.WADO_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=settings.WADO_KEEPALIVE_EXPIRY,
+    timeout=settings.WADO_TIMEOUT,
+    http2=settings.WADO_HTTP2
+)
@@ -1,21 +1,18 @@
 
-from typing import Union
+from typing import Optional, Union
 
-import requests
+import httpx
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from ...module.sessions.cache import session_cache
+
 from ...module.sessions.repository import SessionsRepository
 
 from ...module.sessions.schema import OutSessionSchema
 
-class MyAuth(requests.auth.AuthBase):
-    def __init__(self, auth):
-        self._auth = auth
-    def __call__(self, r):
-        # Implement my authentication
-        r.headers['Authorization'] = self._auth
-        return r
+from .cache import frame_cache
+from .client import wado_clients
 
 class WadoService:
 
@@ -24,24 +21,47 @@ class WadoService:
 
     async def _get_session(self, sessionID: str, studyIUID: str) -> OutSessionSchema:
         id: str = sessionID + "-" + studyIUID
-        return await self._repository.get_by_id(id)
+        session = session_cache.get(id)
+        if session is None:
+            session = await self._repository.get_by_id(id)
+            session_cache.put(session)
+        return session
+
+    async def _get(self, session: OutSessionSchema, path: str, stream: bool = False, accept: Optional[str] = None, accept_encoding: Optional[str] = None) -> httpx.Response:
+        # With stream=True the body is not read, the caller must consume or aclose() the response
+        client = wado_clients.get(session.store_url)
+        # The raw body is relayed with its Content-Encoding, so only the encodings of the client are accepted
+        headers = {"Authorization": session.store_authentication, "Accept-Encoding": accept_encoding or "identity"}
+        if accept:
+            headers["Accept"] = accept
+        request = client.build_request("GET", f"{session.store_url}{path}", headers=headers)
+        return await client.send(request, stream=stream)
 
-    async def get_study(self, sessionID: str, studyUID: str) -> requests.Response:
+    async def get_study(self, sessionID: str, studyUID: str, stream: bool = False, accept_encoding: Optional[str] = None) -> httpx.Response:
         session = await self._get_session(sessionID, studyUID)
-        return requests.get(f"{session.store_url}/studies/{studyUID}/series", auth = MyAuth(session.store_authentication))
+        return await self._get(session, f"/studies/{studyUID}/series", stream, accept_encoding=accept_encoding)
 
-    async def get_series_metadata(self, sessionID: str, studyUID: str, seriesUID: str) -> requests.Response:
+    async def get_series_metadata(self, sessionID: str, studyUID: str, seriesUID: str, stream: bool = False, accept_encoding: Optional[str] = None) -> httpx.Response:
         session = await self._get_session(sessionID, studyUID)
-        return requests.get(f"{session.store_url}/studies/{studyUID}/series/{seriesUID}/metadata", auth = MyAuth(session.store_authentication))
+        return await self._get(session, f"/studies/{studyUID}/series/{seriesUID}/metadata", stream, accept_encoding=accept_encoding)
 
-    async def get_frame(self, sessionID: str, studyUID: str, seriesUID: str, sopUID: str, frames: str) -> requests.Response:
+    async def get_frame(self, sessionID: str, studyUID: str, seriesUID: str, sopUID: str, frames: str, accept: Optional[str] = None, stream: bool = False, accept_encoding: Optional[str] = None) -> httpx.Response:
         session = await self._get_session(sessionID, studyUID)
-        return requests.get(f"{session.store_url}/studies/{studyUID}/series/{seriesUID}/instances/{sopUID}/frames/{frames}", auth = MyAuth(session.store_authentication))
-        
-    async def get_series_thumbnail(self, sessionID: str, studyUID: str, seriesUID: str, q: Union[str, None] = None, viewport: str = "") -> requests.Response:
+
+        # The Accept header selects the transfer syntax and Accept-Encoding the content encoding
+        # of the cached body, so both are part of the cache key
+        key = frame_cache.key(session.store_url, studyUID, seriesUID, sopUID, frames, accept, accept_encoding)
+        cached = await frame_cache.get(key)
+        if cached is not None:
+            return frame_cache.response(cached)
+
+        resp = await self._get(session, f"/studies/{studyUID}/series/{seriesUID}/instances/{sopUID}/frames/{frames}", stream, accept, accept_encoding)
+        return await frame_cache.store(key, resp)
+
+    async def get_series_thumbnail(self, sessionID: str, studyUID: str, seriesUID: str, q: Union[str, None] = None, viewport: str = "", stream: bool = False, accept_encoding: Optional[str] = None) -> httpx.Response:
         session = await self._get_session(sessionID, studyUID)
-        return requests.get(f"{session.store_url}/studies/{studyUID}/series/{seriesUID}/thumbnail", auth = MyAuth(session.store_authentication))
-        
-    async def get_instance_thumbnail(self, sessionID: str, studyUID: str, seriesUID: str, sopUID: str, frames: str, q: Union[str, None] = None, viewport: str = "") -> requests.Response:
+        return await self._get(session, f"/studies/{studyUID}/series/{seriesUID}/thumbnail", stream, accept_encoding=accept_encoding)
+
+    async def get_instance_thumbnail(self, sessionID: str, studyUID: str, seriesUID: str, sopUID: str, frames: str, q: Union[str, None] = None, viewport: str = "", stream: bool = False, accept_encoding: Optional[str] = None) -> httpx.Response:
         session = await self._get_session(sessionID, studyUID)
-        return requests.get(f"{session.store_url}/studies/{studyUID}/series/{seriesUID}/instances/{sopUID}/frames/{frames}/thumbnail", auth = MyAuth(session.store_authentication))
+        return await self._get(session, f"/studies/{studyUID}/series/{seriesUID}/instances/{sopUID}/frames/{frames}/thumbnail", stream, accept_encoding=accept_encoding)